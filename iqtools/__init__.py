@@ -11,5 +11,6 @@ from .grdata import GRData
 from .lcdata import LCData
 from .xdatdata import XDATData
 from .r3fdata import R3FData
+from .headerindex import HeaderIndex, use_header_index, disable_header_index, get_header_index
 from .plotters import *
 from .tools import *
@@ -15,6 +15,11 @@ xaratustrah@github oct-2014
 
 import argparse
 import sys
+import json
+import time
+import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from pprint import pprint
 import logging as log
 import os
@@ -22,69 +27,45 @@ import os
 from .version import __version__
 from .plotters import *
 from .tools import *
+from .headerindex import use_header_index
 
 
 # ------------ MAIN ----------------------------
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('filename', type=str, help='Name of the input file.')
-    parser.add_argument('-hdr', '--header-filename', nargs='?', type=str, default=None,
-                        help='Name of header file.')
-    parser.add_argument('-o', '--outdir', type=str, default=None,
-                        help='output directory.')
-    parser.add_argument('-l', '--lframes', nargs='?', type=int, const=1024, default=1024,
-                        help='Length of frames, default is 1024.')
-    parser.add_argument('-n', '--nframes', nargs='?', type=int, const=10, default=10,
-                        help='Number of frames, default is 10.')
-    parser.add_argument('-s', '--sframes', nargs='?', type=int, const=1, default=1,
-                        help='Starting frame, default is 1.')
-    parser.add_argument('-a', '--span', nargs='?', type=int, default=None,
-                        help='Span in [Hz].')
+def process(filename, args, outfilename_wo_ext=None):
+    """Process one file according to the command line arguments.
 
-    parser.add_argument(
-        '-d', '--dic', help='Print dictionary to screen.', action='store_true')
-    parser.add_argument(
-        '-f', '--fft', help='Plot FFT to file.', action='store_true')
-    parser.add_argument(
-        '-p', '--psd', help='Plot PSD to file.', action='store_true')
-    parser.add_argument(
-        '-g', '--sgram', help='Plot spectrogram to file.', action='store_true')
-    parser.add_argument('-v', '--verbose',
-                        help='Increase output verbosity', action='store_true')
-    parser.add_argument(
-        '-y', '--npy', help='Write dic to NPY file.', action='store_true')
-    parser.add_argument(
-        '-r', '--raw', help='Write file to a raw format.', action='store_true')
+    Args:
+        filename (str): Name of the input file
+        args (argparse.Namespace): Command line arguments
+        outfilename_wo_ext (str, optional): Base name of the output files. Defaults to None, i.e. derived from the input file and the output directory.
 
-    # this one is using argparse %(prog)s for current scrpt name
-    parser.add_argument('--version', action='version',
-                        version=f'%(prog)s {__version__}')
-
-    args = parser.parse_args()
-
-    if args.verbose:
-        log.basicConfig(level=log.DEBUG)
-
-    # here we go:
+    Returns:
+        (list): Names of the written files, or None if the file needs a header file which was not specified
+    """
+    log.info('File {} passed for processing.'.format(filename))
 
-    log.info('File {} passed for processing.'.format(args.filename))
+    if args.header_index:
+        use_header_index(args.header_index)
 
-    iq_data = get_iq_object(args.filename, args.header_filename)
+    iq_data = get_iq_object(filename, args.header_filename)
 
     if not iq_data:
-        print('Datafile needs an additional header file which was not specified. Nothing to do. Aborting...')
-        sys.exit()
+        return None
 
     iq_data.read(args.nframes, args.lframes, args.sframes)
 
-    if args.outdir:
+    if outfilename_wo_ext:
+        os.makedirs(os.path.dirname(os.path.abspath(outfilename_wo_ext)), exist_ok=True)
+    elif args.outdir:
         # handle trailing slash properly
         outfilepath = os.path.join(args.outdir, '')
         outfilename_wo_ext = outfilepath + iq_data.file_basename.split('.')[0]
     else:
         outfilename_wo_ext = iq_data.filename_wo_ext
 
+    outputs = []
+
     # Other command line arguments
 
     if args.fft:
@@ -92,12 +73,14 @@ def main():
         f1, p1, _ = iq_data.get_fft()
         plot_spectrum(f1, p1, cen=iq_data.center, span=args.span, dbm=False,
                       filename='{}_fft'.format(outfilename_wo_ext))
+        outputs.append('{}_fft.png'.format(outfilename_wo_ext))
 
     if args.psd:
         log.info('Generating PSD plot.')
         f2, p2 = iq_data.get_pwelch()
         plot_spectrum(f2, p2, cen=iq_data.center, span=args.span, dbm=True,
                       filename='{}_psd_welch'.format(outfilename_wo_ext))
+        outputs.append('{}_psd_welch.png'.format(outfilename_wo_ext))
 
     if args.sgram:
         iq_data.method = 'npfft'
@@ -105,10 +88,12 @@ def main():
         x, y, z = iq_data.get_power_spectrogram(args.nframes, args.lframes)
         plot_spectrogram(x, y, z, cen = iq_data.center, cmap=cm.jet, dpi=300, dbm=False,
                          span=args.span, filename='{}_spectrogram'.format(outfilename_wo_ext))
+        outputs.append('{}_spectrogram.png'.format(outfilename_wo_ext))
 
     if args.npy:
         log.info('Saving data dictionary in numpy format.')
         write_timedata_to_npy(iq_data, outfilename_wo_ext)
+        outputs.append('{}.npy'.format(outfilename_wo_ext))
 
     if args.dic:
         log.info('Printing dictionary on the screen.')
@@ -118,8 +103,234 @@ def main():
         log.info('Converting data to raw.')
         write_signal_to_bin(iq_data.data_array, outfilename_wo_ext,
                             fs=iq_data.fs, center=iq_data.center, write_header=False)
+        outputs.append('{}.bin'.format(outfilename_wo_ext))
         print('FYI: the sampling frequency is: {}'.format(iq_data.fs))
 
+    return outputs
+
+
+def process_file(filename, args, outfilename_wo_ext=None):
+    """Process one file in batch mode. Failures are caught, so that one broken file
+    does not stop the whole batch.
+
+    Args:
+        filename (str): Name of the input file
+        args (argparse.Namespace): Command line arguments
+        outfilename_wo_ext (str, optional): Base name of the output files. Defaults to None.
+
+    Returns:
+        (dict): Manifest entry of the file
+    """
+    entry = {'filename': filename, 'status': 'ok',
+             'outputs': [], 'error': '', 'elapsed': 0.0}
+    start = time.time()
+    try:
+        outputs = process(filename, args, outfilename_wo_ext)
+        if outputs is None:
+            raise ValueError('Datafile needs an additional header file which was not specified.')
+        entry['outputs'] = outputs
+    except Exception as e:
+        log.error('Processing {} failed: {}'.format(filename, e))
+        entry['status'] = 'failed'
+        entry['error'] = '{}: {}'.format(type(e).__name__, e)
+    entry['elapsed'] = time.time() - start
+    return entry
+
+
+def get_failed_entry(filename, error):
+    """Manifest entry of a file which could not be processed at all.
+
+    Args:
+        filename (str): Name of the input file
+        error (str): Reason
+
+    Returns:
+        (dict): Manifest entry of the file
+    """
+    log.error('Processing {} failed: {}'.format(filename, error))
+    return {'filename': filename, 'status': 'failed',
+            'outputs': [], 'error': error, 'elapsed': 0.0}
+
+
+def get_batch_output_names(filenames, outdir=None):
+    """Base names of the output files in batch mode. The extension of the input file is kept
+    in the name, e.g. a.tiq gives a_tiq, and in the output directory the paths relative to the
+    common directory of all input files are kept, so different inputs give different outputs.
+
+    Args:
+        filenames (list): Names of the input files
+        outdir (str, optional): Output directory. Defaults to None, i.e. next to the input files.
+
+    Returns:
+        (dict): Base name of the output files of each input file
+    """
+    paths = [os.path.abspath(filename) for filename in filenames]
+    if outdir:
+        common = os.path.commonpath([os.path.dirname(path) for path in paths])
+    names = {}
+    for filename, path in zip(filenames, paths):
+        stem, ext = os.path.splitext(path)
+        name = stem + ext.replace('.', '_')
+        if outdir:
+            name = os.path.join(outdir, os.path.relpath(name, common))
+        names[filename] = os.path.normpath(name)
+    return names
+
+
+def process_isolated(filename, args, outfilename_wo_ext):
+    """Process one file in its own worker process, so a crashing worker only fails this file.
+
+    Args:
+        filename (str): Name of the input file
+        args (argparse.Namespace): Command line arguments
+        outfilename_wo_ext (str): Base name of the output files
+
+    Returns:
+        (dict): Manifest entry of the file
+    """
+    try:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            return executor.submit(process_file, filename, args, outfilename_wo_ext).result()
+    except BrokenProcessPool as e:
+        return get_failed_entry(filename, 'Worker process died: {}'.format(e))
+
+
+def process_batch(filenames, args):
+    """Process many files in a pool of worker processes and write a manifest of the results.
+
+    Args:
+        filenames (list): Names of the input files
+        args (argparse.Namespace): Command line arguments
+
+    Returns:
+        (dict): The manifest
+    """
+    started = datetime.datetime.now().isoformat()
+    start = time.time()
+    entries = {}
+    # a file given twice is processed once
+    filenames = list(dict.fromkeys(filenames))
+
+    # files with the same output names would overwrite each others results
+    output_names = get_batch_output_names(filenames, args.outdir)
+    owners = {}
+    todo = []
+    for filename in filenames:
+        name = output_names[filename]
+        if name in owners:
+            entries[filename] = get_failed_entry(
+                filename, 'Output name {} is already used by {}.'.format(name, owners[name]))
+        else:
+            owners[name] = filename
+            todo.append(filename)
+
+    if args.jobs > 1:
+        crashed = []
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            futures = {executor.submit(process_file, filename, args, output_names[filename]): filename
+                       for filename in todo}
+            for future in as_completed(futures):
+                try:
+                    entry = future.result()
+                except BrokenProcessPool:
+                    # a dying worker breaks the pool, it is not known which file caused it
+                    crashed.append(futures[future])
+                    continue
+                log.info('Finished {} ({}).'.format(entry['filename'], entry['status']))
+                entries[entry['filename']] = entry
+        # the files left over by a broken pool get a worker each
+        for filename in crashed:
+            entries[filename] = process_isolated(filename, args, output_names[filename])
+    else:
+        for filename in todo:
+            entries[filename] = process_file(filename, args, output_names[filename])
+
+    # keep the order of the input files
+    files = [entries[filename] for filename in filenames]
+    n_failed = sum(1 for entry in files if entry['status'] != 'ok')
+    manifest = {'iqtools_version': __version__,
+                'started': started,
+                'elapsed': time.time() - start,
+                'jobs': args.jobs,
+                'n_files': len(files),
+                'n_failed': n_failed,
+                'files': files}
+
+    manifest_filename = args.manifest or os.path.join(
+        args.outdir or '.', 'iqtools_manifest.json')
+    # the output directory does not exist yet if no file got far enough to write to it
+    os.makedirs(os.path.dirname(os.path.abspath(manifest_filename)), exist_ok=True)
+    with open(manifest_filename, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    print('Processed {} files, {} failed. Manifest written to {}.'.format(
+        len(files), n_failed, manifest_filename))
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filenames', type=str, nargs='+',
+                        help='Name of the input file. Several files, glob patterns or directories are processed in batch mode.')
+    parser.add_argument('-hdr', '--header-filename', nargs='?', type=str, default=None,
+                        help='Name of header file.')
+    parser.add_argument('-o', '--outdir', type=str, default=None,
+                        help='output directory.')
+    parser.add_argument('-l', '--lframes', nargs='?', type=int, const=1024, default=1024,
+                        help='Length of frames, default is 1024.')
+    parser.add_argument('-n', '--nframes', nargs='?', type=int, const=10, default=10,
+                        help='Number of frames, default is 10.')
+    parser.add_argument('-s', '--sframes', nargs='?', type=int, const=1, default=1,
+                        help='Starting frame, default is 1.')
+    parser.add_argument('-a', '--span', nargs='?', type=int, default=None,
+                        help='Span in [Hz].')
+
+    parser.add_argument(
+        '-d', '--dic', help='Print dictionary to screen.', action='store_true')
+    parser.add_argument(
+        '-f', '--fft', help='Plot FFT to file.', action='store_true')
+    parser.add_argument(
+        '-p', '--psd', help='Plot PSD to file.', action='store_true')
+    parser.add_argument(
+        '-g', '--sgram', help='Plot spectrogram to file.', action='store_true')
+    parser.add_argument('-v', '--verbose',
+                        help='Increase output verbosity', action='store_true')
+    parser.add_argument(
+        '-y', '--npy', help='Write dic to NPY file.', action='store_true')
+    parser.add_argument(
+        '-r', '--raw', help='Write file to a raw format.', action='store_true')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='Number of worker processes in batch mode, default is the number of CPUs.')
+    parser.add_argument('-m', '--manifest', type=str, default=None,
+                        help='Name of the manifest file written in batch mode, default is iqtools_manifest.json in the output directory.')
+
+    parser.add_argument('-x', '--header-index', type=str, default=None,
+                        help='Keep parsed file headers in this index file for faster access next time.')
+
+    # this one is using argparse %(prog)s for current scrpt name
+    parser.add_argument('--version', action='version',
+                        version=f'%(prog)s {__version__}')
+
+    args = parser.parse_args()
+
+    if args.verbose:
+        log.basicConfig(level=log.DEBUG)
+
+    # here we go:
+
+    filenames = find_iq_files(args.filenames)
+    if not filenames:
+        print('No files found. Nothing to do. Aborting...')
+        sys.exit()
+
+    if len(filenames) > 1 or os.path.isdir(args.filenames[0]) or args.manifest:
+        process_batch(filenames, args)
+        return
+
+    if process(filenames[0], args) is None:
+        print('Datafile needs an additional header file which was not specified. Nothing to do. Aborting...')
+        sys.exit()
+
 # ----------------------------------------
 
 
@@ -23,9 +23,10 @@ class BINData(IQBase):
         self.center = 0.0
         # each complex64 sample is 8 bytes on disk
         if self.includes_header:
-            self.nsamples_total = os.path.getsize(filename) / 8 - 1
+            self.nsamples_total = os.path.getsize(filename) // 8 - 1
+            self.read_header()
         else:
-            self.nsamples_total = os.path.getsize(filename) / 8
+            self.nsamples_total = os.path.getsize(filename) // 8
 
     def read(self, nframes=10, lframes=1024, sframes=0):
         """Read a section of the file.
@@ -37,9 +38,17 @@ class BINData(IQBase):
         """        
         self.read_samples(nframes * lframes, offset=sframes * lframes)
 
+    def read_header(self):
+        """Read the sampling and center frequency from the real and imaginary part
+        of the first value.
+        """
+        x = np.fromfile(self.filename, dtype=np.complex64, count=1)
+        self.fs = float(np.real(x[0]))
+        self.center = float(np.imag(x[0]))
+
     def read_samples(self, nsamples, offset=0):
-        """Read samples. Requries the first value to be the header.
-        Please also check the function:
+        """Read samples. If includes_header is set, the first value is the header.
+        Only the requested samples are read. Please also check the function:
             write_signal_to_bin
         in the `tools`.
 
@@ -54,12 +63,21 @@ class BINData(IQBase):
             raise ValueError(
                 'Requested number of samples is larger than the available {} samples.'.format(self.nsamples_total))
 
-        x = np.fromfile(self.filename, dtype=np.complex64)
-        if self.includes_header:
-            self.fs = float(np.real(x[0]))
-            self.center = float(np.imag(x[0]))
-            all_data = x[1:]
-        else:
-            all_data = x[:]
+        self.data_array = np.empty(nsamples, dtype=self.dtype)
+        self.data_array[:] = self.get_memmap()[offset:nsamples + offset]
+
+    def get_memmap(self):
+        """Map the samples after the optional header into memory. Nothing is read from
+        disk until the returned array is sliced.
+
+        Returns:
+            (numpy.memmap): Read-only complex valued array
+        """
+        return np.memmap(self.filename, dtype=np.complex64, mode='r',
+                         offset=8 if self.includes_header else 0, shape=(self.nsamples_total,))
+
+    def _open_chunk_source(self):
+        return self.get_memmap()
 
-        self.data_array = all_data[offset:nsamples + offset]
+    def _read_chunk(self, source, offset, out):
+        out[:] = source[offset:offset + len(out)]
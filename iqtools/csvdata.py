@@ -6,20 +6,38 @@ xaratustrah@github Aug-2015
 
 """
 
+import io
+import logging as log
 import numpy as np
 import time
 import os
 from .iqbase import IQBase
 
+# the line index keeps the byte offset of every this many samples
+LINE_INDEX_STEP = 4096
+# the file is scanned for line breaks in blocks of this many bytes
+LINE_INDEX_BLOCK_SIZE = 2 ** 24
+
 
 class CSVData(IQBase):
-    def __init__(self, filename):
+    header_fields = ('date_time', 'nsamples_total', 'fs', 'center', 'line_index')
+
+    def __init__(self, filename, delimiter='|'):
         super().__init__(filename)
 
+        self.delimiter = delimiter
+
         # Additional fields in this subclass
         self.center = 0.0
-        self.date_time = time.ctime(os.path.getctime(self.filename))
-        self.nsamples_total = sum(1 for line in open(filename)) - 1
+        # byte offsets of the samples 0, LINE_INDEX_STEP, 2 * LINE_INDEX_STEP, ...
+        self.line_index = np.zeros(0, dtype=np.int64)
+        if self.load_indexed_header():
+            self.line_index = np.array(self.line_index, dtype=np.int64)
+        else:
+            self.date_time = time.ctime(os.path.getctime(self.filename))
+            self.read_header()
+            self.build_line_index()
+            self.store_indexed_header()
 
     def read(self, nframes=10, lframes=1024, sframes=0):
         """Read a section of the file.
@@ -28,11 +46,12 @@ class CSVData(IQBase):
             nframes (int, optional): Number of frames to be read. Defaults to 10.
             lframes (int, optional): Length of each frame. Defaults to 1024.
             sframes (int, optional): Starting frame. Defaults to 0.
-        """        
+        """
         self.read_samples(nframes * lframes, offset=sframes * lframes)
 
     def read_samples(self, nsamples, offset=0):
         """Read samples. Requries the first line to be the header.
+        Only the lines of the requested samples are parsed, they are found using the line index.
         Please also check the function:
             write_signal_to_csv
         in the `tools`.
@@ -43,16 +62,77 @@ class CSVData(IQBase):
 
         Raises:
             ValueError: Raises if the requested number of samples is larger than available
-        """        
+        """
 
         if nsamples > self.nsamples_total - offset:
             raise ValueError(
                 'Requested number of samples is larger than the available {} samples.'.format(self.nsamples_total))
 
-        x = np.genfromtxt(self.filename, dtype=np.float32, delimiter='|')
-        self.fs = x[0, 0]
-        self.center = x[0, 1]
-        all_data = x[1:, :]
-        all_data = all_data.view(np.complex64)[:, 0]
+        self.data_array = self.scale_iq(self.read_lines(nsamples, offset), 1,
+                                        np.empty(nsamples, dtype=self.dtype))
+
+    def read_lines(self, nsamples, offset=0):
+        """Parse the lines of a range of samples.
+
+        Args:
+            nsamples (int): Number of samples
+            offset (int, optional): Starting sample. Defaults to 0.
+
+        Returns:
+            (ndarray): Real and imaginary parts with shape (nsamples, 2)
+        """
+        first = offset // LINE_INDEX_STEP
+        last = -(-(offset + nsamples) // LINE_INDEX_STEP)
+        with open(self.filename, 'rb') as f:
+            f.seek(self.line_index[first])
+            if last < len(self.line_index):
+                ba = f.read(self.line_index[last] - self.line_index[first])
+            else:
+                ba = f.read()
+        return np.loadtxt(io.StringIO(ba.decode()), delimiter=self.delimiter, dtype=np.float64,
+                          skiprows=offset - first * LINE_INDEX_STEP, max_rows=nsamples, ndmin=2)
+
+    def read_header(self):
+        """Read the sampling and center frequency from the first line.
+        """
+        with open(self.filename, 'r') as f:
+            line = f.readline()
+        try:
+            fs, center = line.split(self.delimiter)[:2]
+            self.fs = float(fs)
+            self.center = float(center)
+        except ValueError:
+            log.warning('No sampling and center frequency found in the first line.')
+
+    def build_line_index(self):
+        """Scan the file once for line breaks and keep the byte offsets of every
+        LINE_INDEX_STEP samples. This also gives the number of samples.
+        """
+        offsets = []
+        nlines = 0
+        filesize = os.path.getsize(self.filename)
+        with open(self.filename, 'rb') as f:
+            pos = 0
+            while pos < filesize:
+                block = np.frombuffer(f.read(LINE_INDEX_BLOCK_SIZE), dtype=np.uint8)
+                if not len(block):
+                    break
+                # lines start after each line break, the first line is the header
+                starts = pos + np.flatnonzero(block == ord('\n')) + 1
+                # numbers of the samples starting at these offsets
+                samples = nlines + np.arange(len(starts))
+                offsets.append(starts[samples % LINE_INDEX_STEP == 0])
+                nlines += len(starts)
+                pos += len(block)
+            # a last line without line break
+            if filesize:
+                f.seek(filesize - 1)
+                if f.read(1) != b'\n':
+                    nlines += 1
+        self.nsamples_total = max(nlines - 1, 0)
+        # an offset after the last line break does not belong to a sample
+        offsets = np.concatenate(offsets + [np.zeros(0, dtype=np.int64)]).astype(np.int64)
+        self.line_index = offsets[:-(-self.nsamples_total // LINE_INDEX_STEP)]
 
-        self.data_array = all_data[offset:nsamples + offset]
+    def _read_chunk(self, source, offset, out):
+        self.scale_iq(self.read_lines(len(out), offset), 1, out)
@@ -13,16 +13,26 @@ import time
 import os
 from .iqbase import IQBase
 
+# file sink item types: complex floats, interleaved shorts and interleaved bytes
+GR_SAMPLE_TYPES = {'fc32': np.dtype('<c8'),
+                   'ishort': np.dtype('<i2'),
+                   'ibyte': np.dtype('i1')}
+
 
 class GRData(IQBase):
-    def __init__(self, filename, fs, center=0, date_time=""):
+    def __init__(self, filename, fs, center=0, date_time="", sample_type='fc32', scale=1):
         super().__init__(filename)
+
+        assert sample_type in GR_SAMPLE_TYPES
+        self.sample_type = sample_type
+        # raw values are multiplied by this, only when samples are read
+        self.scale = scale
+
         # Additional fields in this subclass
         self.date_time = date_time
         self.center = center
         self.fs = fs
-        # each complex64 sample is 8 bytes on disk
-        self.nsamples_total = os.path.getsize(filename) / 8
+        self.nsamples_total = os.path.getsize(filename) // self.get_sample_size()
 
     def read(self, nframes=10, lframes=1024, sframes=0):
         """Read a section of the file.
@@ -36,7 +46,7 @@ class GRData(IQBase):
         self.read_samples(nframes * lframes, offset=sframes * lframes)
 
     def read_samples(self, nsamples, offset=0):
-        """Read samples.
+        """Read samples. Only the requested samples are read and scaled.
 
         Args:
             nsamples (int): Number of samples to read from file
@@ -49,5 +59,46 @@ class GRData(IQBase):
             raise ValueError(
                 'Requested number of samples is larger than the available {} samples.'.format(self.nsamples_total))
 
-        x = np.fromfile(self.filename, dtype=np.complex64)
-        self.data_array = x[offset:nsamples + offset]
\ No newline at end of file
+        self.data_array = self.get_iq(self.get_memmap()[offset:nsamples + offset],
+                                      np.empty(nsamples, dtype=self.dtype))
+
+    def get_iq(self, raw, out):
+        """Convert raw values to scaled complex values in a single pass.
+
+        Args:
+            raw (ndarray): Raw values as sliced from get_memmap
+            out (ndarray): Complex valued array of the same length to be filled
+
+        Returns:
+            (ndarray): out
+        """
+        if self.sample_type == 'fc32':
+            np.multiply(raw, self.scale, out=out)
+            return out
+        return self.scale_iq(raw, self.scale, out)
+
+    def get_sample_size(self):
+        """Size of a complex valued sample on disk.
+
+        Returns:
+            (int): Number of bytes
+        """
+        dtype = GR_SAMPLE_TYPES[self.sample_type]
+        return dtype.itemsize if dtype.kind == 'c' else 2 * dtype.itemsize
+
+    def get_memmap(self):
+        """Map the samples into memory. Nothing is read from disk until the returned
+        array is sliced. The values are raw, i.e. not scaled.
+
+        Returns:
+            (numpy.memmap): Read-only array, complex valued for fc32, otherwise with shape (nsamples, 2) for I and Q
+        """
+        dtype = GR_SAMPLE_TYPES[self.sample_type]
+        shape = (self.nsamples_total,) if dtype.kind == 'c' else (self.nsamples_total, 2)
+        return np.memmap(self.filename, dtype=dtype, mode='r', shape=shape)
+
+    def _open_chunk_source(self):
+        return self.get_memmap()
+
+    def _read_chunk(self, source, offset, out):
+        self.get_iq(source[offset:offset + len(out)], out)
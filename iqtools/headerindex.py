@@ -0,0 +1,320 @@
+"""
+Persistent index of parsed file headers
+
+Parsing headers of big recordings over and over again is slow, specially when
+browsing directories with thousands of files. The index keeps the parsed header
+fields of each file in an SQLite database, keyed by the path, the size and the
+modification time of the file, so changed files are parsed again.
+
+The index is off by default. It can be switched on for all readers by:
+
+```
+use_header_index('/path/to/headers.sqlite')
+```
+
+"""
+
+import os
+import json
+import time
+import sqlite3
+import re
+import datetime
+import logging as log
+import numpy as np
+
+DEFAULT_HEADER_INDEX_FILE = os.path.join(
+    os.path.expanduser('~'), '.iqtools_header_index.sqlite')
+
+# date and time, fractional seconds and UTC offset of ISO 8601 strings
+ISO_DATE_TIME_PATTERN = re.compile(
+    r'^(\d{4}-\d{2}-\d{2}[T _]\d{2}:\d{2}:\d{2})(?:[.,](\d+))?(Z|[+-]\d{2}:?\d{2})?$')
+
+_header_index = None
+
+
+class HeaderIndex(object):
+    def __init__(self, filename=None):
+        """SQLite based index of parsed file headers.
+
+        Args:
+            filename (str, optional): Database file. Defaults to None, i.e. DEFAULT_HEADER_INDEX_FILE.
+        """
+        self.filename = filename or DEFAULT_HEADER_INDEX_FILE
+        con = self._connect()
+        try:
+            with con:
+                con.execute('''CREATE TABLE IF NOT EXISTS headers (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER,
+                    mtime INTEGER,
+                    reader TEXT,
+                    fs REAL,
+                    center REAL,
+                    nsamples_total INTEGER,
+                    date_time TEXT,
+                    timestamp REAL,
+                    fields TEXT)''')
+                con.execute(
+                    'CREATE INDEX IF NOT EXISTS headers_timestamp ON headers (timestamp)')
+                con.execute(
+                    'CREATE INDEX IF NOT EXISTS headers_center ON headers (center)')
+        finally:
+            con.close()
+
+    def _connect(self):
+        # a fresh connection for each operation, so the index can be shared between processes
+        return sqlite3.connect(self.filename, timeout=30)
+
+    @staticmethod
+    def get_file_key(filename):
+        """Return the key of a file in the index.
+
+        Args:
+            filename (str): File name
+
+        Returns:
+            (tuple): Absolute path, size and modification time in ns
+        """
+        st = os.stat(filename)
+        return os.path.abspath(filename), st.st_size, st.st_mtime_ns
+
+    def lookup(self, filename, reader):
+        """Return the cached header fields of a file, if the file did not change since it was indexed.
+
+        Args:
+            filename (str): File name
+            reader (str): Name of the reader class
+
+        Returns:
+            (dict): Header fields, or None if the file is not in the index or has changed
+        """
+        try:
+            path, size, mtime = self.get_file_key(filename)
+        except OSError:
+            return None
+        con = self._connect()
+        try:
+            row = con.execute('SELECT size, mtime, reader, fields FROM headers WHERE path = ?',
+                              (path,)).fetchone()
+        except sqlite3.Error as e:
+            log.warning('Could not read the header index: {}'.format(e))
+            return None
+        finally:
+            con.close()
+        if row is None or row[0] != size or row[1] != mtime or row[2] != reader:
+            return None
+        log.info('Header of {} found in the index.'.format(filename))
+        return json.loads(row[3])
+
+    def store(self, iq_data, fields):
+        """Store the header fields of a reader object in the index.
+
+        Args:
+            iq_data (iqbase): A derivative of the iqbase class
+            fields (list): Names of the attributes to be stored
+        """
+        try:
+            path, size, mtime = self.get_file_key(iq_data.filename)
+        except OSError:
+            return
+        values = {name: _to_json(getattr(iq_data, name)) for name in fields}
+        date_time = str(getattr(iq_data, 'date_time', '') or '')
+        con = self._connect()
+        try:
+            with con:
+                con.execute('INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                            (path, size, mtime, type(iq_data).__name__,
+                             float(iq_data.fs), float(getattr(iq_data, 'center', 0.0)),
+                             int(iq_data.nsamples_total), date_time,
+                             parse_date_time(date_time), json.dumps(values)))
+        except sqlite3.Error as e:
+            log.warning('Could not write to the header index: {}'.format(e))
+        finally:
+            con.close()
+
+    def remove(self, filename):
+        """Remove a file from the index.
+
+        Args:
+            filename (str): File name
+        """
+        con = self._connect()
+        try:
+            with con:
+                con.execute('DELETE FROM headers WHERE path = ?',
+                            (os.path.abspath(filename),))
+        finally:
+            con.close()
+
+    def scan(self, paths, header_filename=None):
+        """Parse the headers of all IQ files in the given paths and add them to the index.
+        Files which are already indexed and did not change are skipped.
+
+        Args:
+            paths (list): File names, glob patterns or directories
+            header_filename (str, optional): Name of header file, for formats that need one. Defaults to None.
+
+        Returns:
+            (int): Number of files found in the index after the scan
+        """
+        # import here, tools imports all readers which in turn import this module
+        from .tools import find_iq_files, get_iq_object
+
+        if isinstance(paths, str):
+            paths = [paths]
+        n = 0
+        for filename in find_iq_files(paths):
+            if self.contains(filename):
+                n += 1
+                continue
+            try:
+                iq_data = get_iq_object(filename, header_filename)
+            except Exception as e:
+                log.warning('Could not index {}: {}'.format(filename, e))
+                continue
+            if iq_data is not None and self.contains(filename):
+                n += 1
+        return n
+
+    def contains(self, filename):
+        """Check whether an unchanged version of the file is in the index.
+
+        Args:
+            filename (str): File name
+
+        Returns:
+            (bool): True if the file is indexed
+        """
+        try:
+            path, size, mtime = self.get_file_key(filename)
+        except OSError:
+            return False
+        con = self._connect()
+        try:
+            row = con.execute('SELECT 1 FROM headers WHERE path = ? AND size = ? AND mtime = ?',
+                              (path, size, mtime)).fetchone()
+        finally:
+            con.close()
+        return row is not None
+
+    def query(self, start=None, stop=None, center_min=None, center_max=None):
+        """Find indexed files by recording time and center frequency.
+
+        Args:
+            start (datetime, str or float, optional): Earliest recording time. Defaults to None.
+            stop (datetime, str or float, optional): Latest recording time. Defaults to None.
+            center_min (float, optional): Lowest center frequency in [Hz]. Defaults to None.
+            center_max (float, optional): Highest center frequency in [Hz]. Defaults to None.
+
+        Returns:
+            (list): Dictionaries with path, reader, fs, center, nsamples_total and date_time, sorted by time
+        """
+        conditions = []
+        parameters = []
+        for column, operator, value in (('timestamp', '>=', _to_timestamp(start)),
+                                        ('timestamp', '<=', _to_timestamp(stop)),
+                                        ('center', '>=', center_min),
+                                        ('center', '<=', center_max)):
+            if value is not None:
+                conditions.append('{} {} ?'.format(column, operator))
+                parameters.append(value)
+        sql = 'SELECT path, reader, fs, center, nsamples_total, date_time FROM headers'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY timestamp, path'
+        con = self._connect()
+        try:
+            rows = con.execute(sql, parameters).fetchall()
+        finally:
+            con.close()
+        return [dict(zip(('path', 'reader', 'fs', 'center', 'nsamples_total', 'date_time'), row))
+                for row in rows]
+
+
+def use_header_index(filename=None):
+    """Switch on the header index for all readers.
+
+    Args:
+        filename (str, optional): Database file. Defaults to None, i.e. DEFAULT_HEADER_INDEX_FILE.
+
+    Returns:
+        (HeaderIndex): The active index
+    """
+    global _header_index
+    _header_index = HeaderIndex(filename)
+    return _header_index
+
+
+def disable_header_index():
+    """Switch off the header index.
+    """
+    global _header_index
+    _header_index = None
+
+
+def get_header_index():
+    """Return the active header index.
+
+    Returns:
+        (HeaderIndex): The active index, or None if the index is switched off
+    """
+    return _header_index
+
+
+def parse_date_time(date_time):
+    """Convert the date and time string of a header to a POSIX time stamp. ISO 8601 strings
+    as used in TIQ files and strings in the format of time.ctime are understood. Times with
+    a UTC offset are converted accordingly, times without are taken as local time, for the
+    stored values and the query bounds alike.
+
+    Args:
+        date_time (str): Date and time
+
+    Returns:
+        (float): Seconds since the epoch, or None if the string could not be parsed
+    """
+    if not date_time:
+        return None
+    try:
+        return datetime.datetime.fromisoformat(_normalize_iso_date_time(date_time)).timestamp()
+    except ValueError:
+        pass
+    try:
+        return time.mktime(time.strptime(date_time))
+    except ValueError:
+        return None
+
+
+def _normalize_iso_date_time(date_time):
+    # older versions of fromisoformat only accept 3 or 6 digits of fractional seconds and no Z
+    match = ISO_DATE_TIME_PATTERN.match(date_time.strip())
+    if not match:
+        return date_time
+    base, fraction, offset = match.groups()
+    if fraction:
+        base += '.' + fraction[:6].ljust(6, '0')
+    if offset == 'Z':
+        offset = '+00:00'
+    elif offset and ':' not in offset:
+        offset = offset[:3] + ':' + offset[3:]
+    return base + (offset or '')
+
+
+def _to_timestamp(value):
+    if value is None or isinstance(value, (int, float)):
+        return value
+    if isinstance(value, datetime.datetime):
+        return value.timestamp()
+    return parse_date_time(value)
+
+
+def _to_json(value):
+    # numpy types and byte strings are not JSON serializable
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, bytes):
+        return value.decode(errors='replace')
+    return value
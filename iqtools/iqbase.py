@@ -6,11 +6,146 @@ xaratustrah@github Aug-2015
 """
 
 import os
+import tempfile
+import logging as log
+from collections import OrderedDict
+from functools import lru_cache
 import numpy as np
-from scipy.signal import welch, find_peaks_cwt
+import scipy.fft
+from scipy.signal import welch
+from scipy.ndimage import minimum_filter1d, maximum_filter1d
 from abc import ABCMeta, abstractmethod
 from scipy.signal.windows import dpss
 import pyfftw
+from .headerindex import get_header_index
+
+# FFTW wisdom is kept here between sessions
+FFTW_WISDOM_FILE = os.path.join(os.path.expanduser('~'), '.iqtools_fftw_wisdom')
+# number of plans kept in memory together with their aligned buffers
+FFTW_PLAN_CACHE_SIZE = 8
+# frames are transformed in batches of about this many samples
+FFTW_BATCH_SAMPLES = 2 ** 20
+# frames are tapered in batches of about this many samples
+MTM_BATCH_SAMPLES = 2 ** 20
+# rows of spectrograms are integrated in batches of about this many bins
+BAND_BATCH_SAMPLES = 2 ** 22
+# rows of spectrograms are searched for peaks in batches of about this many bins
+PEAK_BATCH_SAMPLES = 2 ** 22
+# record of a peak found by get_peaks, width is the full width at half prominence
+PEAK_TYPE = np.dtype([('row', np.int64), ('bin', np.int64), ('frequency', np.float64),
+                      ('power', np.float64), ('width', np.float64)])
+
+# the wisdom file starts with this, followed by the length and the bytes of each wisdom entry
+FFTW_WISDOM_MAGIC = b'IQTOOLS FFTW WISDOM 1\n'
+
+_fftw_plans = OrderedDict()
+_fftw_wisdom_loaded = False
+
+
+def load_fftw_wisdom(filename=None):
+    """Load FFTW wisdom from a file, so planning does not need to start from scratch.
+
+    Args:
+        filename (string, optional): Wisdom file. Defaults to None, i.e. FFTW_WISDOM_FILE.
+
+    Returns:
+        (bool): True if wisdom was loaded
+
+    Raises:
+        ValueError: Raises if the file is not a wisdom file
+    """
+    filename = filename or FFTW_WISDOM_FILE
+    if not os.path.exists(filename):
+        return False
+    with open(filename, 'rb') as f:
+        ba = f.read()
+    if not ba.startswith(FFTW_WISDOM_MAGIC):
+        raise ValueError('{} is not an FFTW wisdom file.'.format(filename))
+    wisdom = []
+    pos = len(FFTW_WISDOM_MAGIC)
+    while pos < len(ba):
+        length = int.from_bytes(ba[pos:pos + 8], 'little')
+        pos += 8
+        if pos + length > len(ba):
+            raise ValueError('{} is truncated.'.format(filename))
+        wisdom.append(ba[pos:pos + length])
+        pos += length
+    pyfftw.import_wisdom(tuple(wisdom))
+    return True
+
+
+def save_fftw_wisdom(filename=None):
+    """Save the FFTW wisdom gathered so far to a file. The file is replaced at once,
+    so processes saving at the same time do not corrupt it.
+
+    Args:
+        filename (string, optional): Wisdom file. Defaults to None, i.e. FFTW_WISDOM_FILE.
+    """
+    filename = filename or FFTW_WISDOM_FILE
+    fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)),
+                                        prefix=os.path.basename(filename) + '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(FFTW_WISDOM_MAGIC)
+            for entry in pyfftw.export_wisdom():
+                f.write(len(entry).to_bytes(8, 'little'))
+                f.write(entry)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
+
+
+def get_fftw_plan(nframes, lframes, dtype=np.complex64, threads=1):
+    """Return an FFTW plan for the row wise FFT of an (nframes, lframes) array. Plans are cached
+    together with their aligned input and output buffers, so only the first call for a given
+    shape, type and number of threads pays for the planning. Wisdom is loaded from disk before
+    the first planning and saved again after each new plan.
+
+    ```
+    plan = get_fftw_plan(nframes, lframes)
+    plan.input_array[:] = frames
+    spectra = plan()
+    ```
+
+    Args:
+        nframes (int): Number of frames, i.e. rows
+        lframes (int): Length of frames, i.e. columns
+        dtype (numpy.dtype, optional): Complex type of the buffers. Defaults to np.complex64.
+        threads (int, optional): Number of threads. Defaults to 1.
+
+    Returns:
+        (pyfftw.FFTW): Plan, its input_array and output_array are reused between calls
+    """
+    global _fftw_wisdom_loaded
+
+    key = (nframes, lframes, np.dtype(dtype).str, threads)
+    if key in _fftw_plans:
+        _fftw_plans.move_to_end(key)
+        return _fftw_plans[key]
+
+    if not _fftw_wisdom_loaded:
+        _fftw_wisdom_loaded = True
+        try:
+            load_fftw_wisdom()
+        except Exception as e:
+            log.warning('Could not load FFTW wisdom: {}'.format(e))
+
+    input_array = pyfftw.empty_aligned((nframes, lframes), dtype=dtype)
+    output_array = pyfftw.empty_aligned((nframes, lframes), dtype=dtype)
+    plan = pyfftw.FFTW(input_array, output_array, axes=(1,),
+                       flags=('FFTW_MEASURE',), threads=threads)
+
+    _fftw_plans[key] = plan
+    if len(_fftw_plans) > FFTW_PLAN_CACHE_SIZE:
+        _fftw_plans.popitem(last=False)
+
+    try:
+        save_fftw_wisdom()
+    except OSError as e:
+        log.warning('Could not save FFTW wisdom: {}'.format(e))
+    return plan
+
 
 def pmtm(signal, dpss, axis=-1):
     """Estimate the power spectral density of the input signal. This function is adopted from [this project](https://github.com/xaratustrah/multitaper) which was in turn a fork of [this project](https://github.com/nerdull/multitaper).
@@ -32,10 +167,106 @@ def pmtm(signal, dpss, axis=-1):
         sig_exp_shape) * dpss.reshape(tap_exp_shape)
     return np.fft.fftshift(np.mean(np.absolute(np.fft.fft(signal_tapered, axis=axis_p + 1))**2, axis=axis_p), axes=axis_p)
 
+@lru_cache(maxsize=16)
+def get_dpss(M, NW=4, Kmax=6):
+    """Return the Slepian matrix and its concentration ratios. Results are cached, since
+    the same frame length is usually used over and over again.
+
+    Args:
+        M (int): Window length
+        NW (float, optional): Standardized half bandwidth. Defaults to 4.
+        Kmax (int, optional): Number of tapers. Defaults to 6.
+
+    Returns:
+        (tuple): Read-only Slepian matrix with shape (Kmax, M) and the concentration ratios
+    """
+    tapers, ratios = dpss(M=M, NW=NW, Kmax=Kmax, return_ratios=True)
+    tapers.flags.writeable = False
+    ratios.flags.writeable = False
+    return tapers, ratios
+
+
+def pmtm_batched(frames, tapers, ratios=None, adaptive=False, dtype=np.complex64, batch_samples=MTM_BATCH_SAMPLES):
+    """Multitaper power spectrum of every row of a 2D array. Unlike pmtm, the tapered copies
+    of the signal are never materialized for all tapers at once. The rows are processed in
+    batches and the power of one taper after the other is accumulated, so the memory needed
+    on top of the result is bounded by the batch size.
+
+    Without adaptive weighting the result is the same as pmtm(frames, tapers, axis=1).
+    With adaptive weighting the eigenspectra are combined with the iterative weights of Thomson,
+    which reduce the broadband leakage of the higher order tapers.
+
+    Args:
+        frames (ndarray): Real or complex values with shape (nframes, lframes)
+        tapers (ndarray): The Slepian matrix with shape (Kmax, lframes)
+        ratios (ndarray, optional): Concentration ratios of the tapers, needed for adaptive weighting. Defaults to None.
+        adaptive (bool, optional): Use adaptive weighting. Defaults to False.
+        dtype (numpy.dtype, optional): Complex type of the calculation, np.complex128 runs in double precision. Defaults to np.complex64.
+        batch_samples (int, optional): Approximate number of samples processed at once. Defaults to MTM_BATCH_SAMPLES.
+
+    Returns:
+        (ndarray): The multitaper frames with shape (nframes, lframes), shifted in the correct order
+    """
+    nframes, lframes = np.shape(frames)
+    real_dtype = np.finfo(dtype).dtype
+    tapers = np.asarray(tapers, dtype=real_dtype)
+    out = np.empty((nframes, lframes), dtype=real_dtype)
+    nrows = max(1, batch_samples // lframes)
+
+    for i in range(0, nframes, nrows):
+        batch = np.asarray(frames[i:i + nrows], dtype=dtype)
+        if adaptive:
+            sk = np.empty((len(tapers), len(batch), lframes), dtype=real_dtype)
+            for k, taper in enumerate(tapers):
+                sk[k] = np.abs(scipy.fft.fft(batch * taper, axis=1)) ** 2
+            # tapers have unit energy, so white noise of this variance has a flat spectrum of the same height
+            variance = np.mean(np.abs(batch) ** 2, axis=1, keepdims=True)
+            acc = get_adaptive_psd(sk, ratios, variance)
+        else:
+            acc = np.zeros((len(batch), lframes), dtype=real_dtype)
+            for taper in tapers:
+                acc += np.abs(scipy.fft.fft(batch * taper, axis=1)) ** 2
+            acc /= len(tapers)
+        out[i:i + nrows] = np.fft.fftshift(acc, axes=1)
+    return out
+
+
+def get_adaptive_psd(sk, ratios, variance, max_iter=100, tol=1e-6):
+    """Combine eigenspectra using the adaptive weighting of Thomson.
+
+    Args:
+        sk (ndarray): Eigenspectra with shape (Kmax, nframes, lframes)
+        ratios (ndarray): Concentration ratios of the tapers
+        variance (ndarray): Variance of each frame with shape (nframes, 1)
+        max_iter (int, optional): Maximum number of iterations. Defaults to 100.
+        tol (float, optional): Relative change at which the iteration stops. Defaults to 1e-6.
+
+    Returns:
+        (ndarray): Power spectra with shape (nframes, lframes)
+    """
+    if len(sk) == 1:
+        return sk[0]
+    ratios = np.reshape(ratios, (-1, 1, 1)).astype(sk.dtype)
+    # start with the two best concentrated tapers
+    psd = (sk[0] + sk[1]) / 2
+    for _ in range(max_iter):
+        weights = np.sqrt(ratios) * psd / (ratios * psd + (1 - ratios) * variance)
+        weights **= 2
+        new_psd = np.sum(weights * sk, axis=0) / np.sum(weights, axis=0)
+        done = np.all(np.abs(new_psd - psd) <= tol * np.abs(psd))
+        psd = new_psd
+        if done:
+            break
+    return psd
+
+
 class IQBase(object):
     # Abstract class
     __metaclass__ = ABCMeta
 
+    # attributes set by the header parser, these are kept in the header index if it is switched on
+    header_fields = ()
+
     def __init__(self, filename):
 
         # fields required in all subclasses
@@ -43,6 +274,8 @@ class IQBase(object):
 
         self.filename = filename
         self.data_array = None
+        # precision of data_array and of everything derived from it, np.complex128 for double precision
+        self.dtype = np.complex64
         self.scale = 1
         self.nsamples_total = 0
         self.fs = 0.0
@@ -52,10 +285,42 @@ class IQBase(object):
         self.filename_wo_ext = os.path.splitext(filename)[0]
         self.window = 'rectangular'
         self.method = 'npfft'
+        self.fftw_threads = os.cpu_count() or 1
+        # segment length and overlap of the welch method, None means the whole frame and half a segment
+        self.welch_nperseg = None
+        self.welch_noverlap = None
+        # parameters of the mtm method
+        self.mtm_nw = 4
+        self.mtm_kmax = 6
+        self.mtm_adaptive = False
 
     def __str__(self):
         return self.dic2htmlstring(vars(self))
 
+    def load_indexed_header(self):
+        """Restore the header fields from the header index, if it is switched on and
+        the file did not change since it was indexed.
+
+        Returns:
+            (bool): True if the header fields were restored, False if the header needs to be parsed
+        """
+        index = get_header_index()
+        if index is None or not self.header_fields:
+            return False
+        fields = index.lookup(self.filename, type(self).__name__)
+        if fields is None or set(fields) != set(self.header_fields):
+            return False
+        for name, value in fields.items():
+            setattr(self, name, value)
+        return True
+
+    def store_indexed_header(self):
+        """Store the header fields in the header index, if it is switched on.
+        """
+        index = get_header_index()
+        if index is not None and self.header_fields:
+            index.store(self, self.header_fields)
+
     def dic2htmlstring(self, dic):
         """Converts a dictionary to an HTML string
 
@@ -98,6 +363,15 @@ class IQBase(object):
                 self.date_time)
             return outstr
 
+    def get_real_dtype(self):
+        """Real type matching the precision of the object, e.g. for windows and power values.
+
+        Returns:
+            (numpy.dtype): np.float32 for np.complex64 and np.float64 for np.complex128
+        """
+        assert np.dtype(self.dtype) in [np.complex64, np.complex128]
+        return np.finfo(self.dtype).dtype
+
     def get_record_length(self):
         """Returns the record length
 
@@ -118,6 +392,84 @@ class IQBase(object):
         """        
         pass
 
+    def iter_chunks(self, chunk_samples, overlap=0, start=0, stop=None):
+        """Iterate over the file chunk by chunk with constant memory. The file is opened
+        only once and data_array is left untouched. The yielded array is a buffer that is
+        reused for the next chunk, so make a copy if you need to keep it.
+
+        ```
+        for offset, x in iq.iter_chunks(2**20):
+            ff, pp, _ = iq.get_fft(x)
+        ```
+
+        Args:
+            chunk_samples (int): Number of samples in each chunk
+            overlap (int, optional): Number of samples shared by consecutive chunks. Defaults to 0.
+            start (int, optional): First sample. Defaults to 0.
+            stop (int, optional): Stop before this sample. Defaults to None, i.e. end of the file.
+
+        Raises:
+            ValueError: Raises if the overlap is not smaller than the chunk
+
+        Yields:
+            (tuple): Offset of the chunk in samples and the complex valued chunk. The last chunk may be shorter.
+        """
+        if not 0 <= overlap < chunk_samples:
+            raise ValueError('Overlap has to be smaller than the chunk size.')
+
+        source = self._open_chunk_source()
+        try:
+            if stop is None or stop > self.nsamples_total:
+                stop = int(self.nsamples_total)
+            buffer = np.empty(chunk_samples, dtype=self.dtype)
+            offset = start
+            while offset < stop:
+                out = buffer[:min(chunk_samples, stop - offset)]
+                self._read_chunk(source, offset, out)
+                yield offset, out
+                if offset + len(out) >= stop:
+                    break
+                offset += chunk_samples - overlap
+        finally:
+            if hasattr(source, 'close'):
+                source.close()
+
+    def _open_chunk_source(self):
+        """Open whatever _read_chunk needs, e.g. a file handle or a memory map. It is
+        closed after iterating if it has a close method.
+        """
+        return None
+
+    def _read_chunk(self, source, offset, out):
+        """Fill out with len(out) samples starting at offset. This fallback goes through
+        read_samples, readers override it with a version working on the source.
+
+        Args:
+            source (object): Whatever _open_chunk_source returned
+            offset (int): Starting sample
+            out (ndarray): Buffer to be filled
+        """
+        data_array = self.data_array
+        self.read_samples(len(out), offset)
+        out[:] = self.data_array
+        self.data_array = data_array
+
+    @staticmethod
+    def scale_iq(iq, scale, out):
+        """Scale interleaved I and Q values into a complex valued array in a single pass,
+        without any intermediate arrays.
+
+        Args:
+            iq (ndarray): Raw values with shape (nsamples, 2), I in the first and Q in the second column
+            scale (float): Scaling factor
+            out (ndarray): Contiguous complex valued array of length nsamples
+
+        Returns:
+            (ndarray): out
+        """
+        np.multiply(iq, scale, out=out.view(out.real.dtype).reshape(-1, 2))
+        return out
+
     def get_window(self, n=None):
         """Return a suitable windowing function for FFT
 
@@ -132,15 +484,17 @@ class IQBase(object):
         assert self.window in ['rectangular',
                                'bartlett', 'blackman', 'hamming', 'hanning']
         if self.window == 'rectangular':
-            return np.ones(n)
+            window = np.ones(n)
         elif self.window == 'bartlett':
-            return np.bartlett(n)
+            window = np.bartlett(n)
         elif self.window == 'blackman':
-            return np.blackman(n)
+            window = np.blackman(n)
         elif self.window == 'hamming':
-            return np.hamming(n)
+            window = np.hamming(n)
         else:
-            return np.hanning(n)
+            window = np.hanning(n)
+        # a double window would upcast single precision data
+        return window.astype(self.get_real_dtype())
 
     def get_fft_freqs_only(self, x=None):
         """Return FFT frequencies only
@@ -195,12 +549,14 @@ class IQBase(object):
             data = x
 
         termination = 50  # in Ohms for termination resistor
-        data = np.reshape(data, (nf, lf))
+        data = np.reshape(np.asarray(data, dtype=self.dtype), (nf, lf))
         freqs = self.get_fft_freqs_only(data[0])
-        v_peak_iq = np.fft.fft(
+        # unlike numpy, scipy keeps single precision
+        v_peak_iq = scipy.fft.fft(
             data * self.get_window(lf), axis=1)
         v_peak_iq = np.average(v_peak_iq, axis=0) / lf * nf
-        v_rms = abs(v_peak_iq) / np.sqrt(2)
+        # a python float does not upcast single precision, np.sqrt(2) would
+        v_rms = abs(v_peak_iq) / 2 ** 0.5
         p_avg = v_rms ** 2 / termination
         # freqs is already fft shifted
         return freqs, np.fft.fftshift(p_avg), np.fft.fftshift(v_peak_iq)
@@ -218,6 +574,7 @@ class IQBase(object):
             data = self.data_array
         else:
             data = x
+        data = np.asarray(data, dtype=self.dtype)
         n = data.size
         f, p_avg = welch(data * self.get_window(n), self.fs,
                          nperseg=data.size, return_onesided=False)
@@ -240,6 +597,10 @@ class IQBase(object):
             plt.plot(y[:,i], z[:, i])
         ```
 
+        The welch method averages the periodograms of overlapping segments within each frame. The
+        segment length and overlap can be set in welch_nperseg and welch_noverlap, in which case the
+        number of columns is the segment length.
+
         Args:
             nframes (int): Number of time frames, i.e. rows of matrix
             lframes (int): Number of frequency bins, i.e. number of columns of matrix
@@ -249,46 +610,159 @@ class IQBase(object):
             (tuple): time, frequency and power as mesh grids
         """
 
-        assert self.method in ['npfft', 'fftw', 'welch', 'mtm']
+        zz = self.get_power_frames(self.data_array, nframes, lframes)
+        xx, yy = self.get_spectrogram_mesh(nframes, lframes, sparse=sparse)
+        return xx, yy, zz
+
+    def get_power_frames(self, x, nframes, lframes):
+        """Transform consecutive frames of a data array to power using the selected method.
+        This is the work horse of the spectrogram functions.
 
-        # define an empty np-array for appending
-        pout = np.zeros(nframes * lframes)
+        Args:
+            x (ndarray): Complex valued data array of at least nframes * lframes samples
+            nframes (int): Number of time frames, i.e. rows of matrix
+            lframes (int): Number of frequency bins, i.e. number of columns of matrix
+
+        Returns:
+            (ndarray): Power with shape (nframes, lframes) in the precision of the object, frequencies are shifted to the center
+        """
+        assert self.method in ['npfft', 'fftw', 'welch', 'mtm']
+        x = np.asarray(x[:nframes * lframes], dtype=self.dtype)
 
         if self.method == 'npfft':
-            sig = np.reshape(self.data_array, (nframes, lframes))
-            # fft must return power, so needs to be squared
-            zz = np.abs(np.fft.fftshift(np.fft.fft(sig, axis=1), axes=1)) ** 2
+            sig = np.reshape(x, (nframes, lframes))
+            # fft must return power, so needs to be squared. scipy keeps single precision, numpy does not
+            zz = np.abs(np.fft.fftshift(scipy.fft.fft(sig, axis=1), axes=1)) ** 2
 
         elif self.method == 'fftw':
-            pyfftw.config.NUM_THREADS = 4
-            pyfftw.config.PLANNER_EFFORT = 'FFTW_MEASURE'
-            qq = pyfftw.empty_aligned([nframes, lframes], dtype='complex64')
-            qq [:,:] = np.reshape(self.data_array, (nframes, lframes))
-            zz = np.abs(np.fft.fftshift(pyfftw.interfaces.numpy_fft.fft(qq, axis=1), axes=1)) ** 2
+            sig = np.reshape(x, (nframes, lframes))
+            # the frames go through a cached plan in batches, so the aligned buffers stay small
+            nrows = min(nframes, max(1, FFTW_BATCH_SAMPLES // lframes))
+            plan = get_fftw_plan(nrows, lframes, dtype=self.dtype, threads=self.fftw_threads)
+            zz = np.empty((nframes, lframes), dtype=self.get_real_dtype())
+            for i in range(0, nframes, nrows):
+                n = min(nrows, nframes - i)
+                plan.input_array[:n] = sig[i:i + n]
+                plan.input_array[n:] = 0
+                plan()
+                zz[i:i + n] = np.abs(np.fft.fftshift(plan.output_array[:n], axes=1)) ** 2
 
         elif self.method == 'welch':
-            # go through the data array section wise and create a results array
-            for i in range(nframes):
-                f, p = self.get_pwelch(
-                    self.data_array[i * lframes:(i + 1) * lframes] * self.get_window(lframes))
-                pout[i * lframes:(i + 1) * lframes] = p
-            # fold the results array to the mesh grid
-            zz = np.reshape(pout, (nframes, lframes))
+            # all frames at once, each frame is cut into overlapping windowed segments whose
+            # periodograms are averaged, so there are nperseg frequency bins per frame
+            nperseg = self.get_nbins(lframes)
+            sig = np.reshape(x, (nframes, lframes))
+            _, zz = welch(sig, self.fs, window=self.get_window(nperseg), nperseg=nperseg,
+                          noverlap=self.welch_noverlap, return_onesided=False, axis=1)
+            zz = np.fft.fftshift(zz, axes=1)
 
         elif self.method == 'mtm':
-            mydpss = dpss(M=lframes, NW=4, Kmax=6)
-            #f = self.get_fft_freqs_only(x[0:lframes])
-            sig = np.reshape(self.data_array, (nframes, lframes))
-            zz = pmtm(sig, mydpss, axis=1)
+            tapers, ratios = get_dpss(lframes, self.mtm_nw, self.mtm_kmax)
+            sig = np.reshape(x, (nframes, lframes))
+            zz = pmtm_batched(sig, tapers, ratios, adaptive=self.mtm_adaptive, dtype=self.dtype)
+
+        return zz
+
+    def get_nbins(self, lframes):
+        """Number of frequency bins per frame the selected method produces.
 
+        Args:
+            lframes (int): Length of frames
+
+        Returns:
+            (int): Number of frequency bins
+        """
+        if self.method == 'welch' and self.welch_nperseg:
+            return min(self.welch_nperseg, lframes)
+        return lframes
+
+    def get_spectrogram_mesh(self, nframes, lframes, sparse=False):
+        """Create the time and frequency meshgrids of a spectrogram.
+
+        Args:
+            nframes (int): Number of time frames, i.e. rows of matrix
+            lframes (int): Length of frames, the number of columns is given by get_nbins
+            sparse (bool, optional): Return the grids in sparse form. Defaults to False.
+
+        Returns:
+            (tuple): frequency and time as mesh grids
+        """
+        nbins = self.get_nbins(lframes)
+        real_dtype = self.get_real_dtype()
         # create a mesh grid from 0 to nframes -1 in Y direction
-        xx, yy = np.meshgrid(np.arange(lframes, dtype=np.float32), np.arange(nframes, dtype=np.float32), sparse=sparse)
+        xx, yy = np.meshgrid(np.arange(nbins, dtype=real_dtype), np.arange(nframes, dtype=real_dtype), sparse=sparse)
         yy = yy * lframes / self.fs
         # center the frequencies around zero
         xx = xx - xx[-1, -1] / 2
-        xx = xx * self.fs / lframes
+        xx = xx * self.fs / nbins
+
+        return xx.astype(real_dtype), yy.astype(real_dtype)
+
+    def get_power_spectrogram_streamed(self, lframes, nframes=None, sframes=0, every=1, chunk_frames=None, filename=None, sparse=True):
+        """Get power spectrogram of a whole file, or of a large part of it, without reading it
+        into data_array. The file is read chunk by chunk, each chunk is transformed using the
+        selected method and optionally averaged in time, so the memory needed for the data
+        is bounded by the chunk size instead of by the file size.
 
-        return xx.astype(np.float32), yy.astype(np.float32), zz.astype(np.float32)
+        Averaging every such frames gives the same result as get_averaged_spectrogram
+        would give on the full spectrogram, with the time of each row being the mean time
+        of the averaged frames.
+
+        ```
+        iq.method = 'fftw'
+        xx, yy, zz = iq.get_power_spectrogram_streamed(lframes=2**18, every=8, filename='run1_zz')
+        ```
+
+        Args:
+            lframes (int): Number of frequency bins, i.e. number of columns of matrix
+            nframes (int, optional): Number of time frames before averaging. Defaults to None, i.e. until the end of the file.
+            sframes (int, optional): Starting frame. Defaults to 0.
+            every (int, optional): Average every such frames in time. Defaults to 1, i.e. no averaging.
+            chunk_frames (int, optional): Number of frames read at once. Defaults to None, i.e. chunks of about 2^22 samples.
+            filename (string, optional): If given, zz is a memory map backed by this NPY file instead of an array in memory. Defaults to None.
+            sparse (bool, optional): Return xx and yy in sparse form. Defaults to True.
+
+        Returns:
+            (tuple): time, frequency and power as mesh grids
+
+        Raises:
+            ValueError: Raises if the requested frames are beyond the end of the file
+        """
+        if nframes is None:
+            nframes = int(self.nsamples_total) // lframes - sframes
+        if nframes < 0 or (sframes + nframes) * lframes > self.nsamples_total:
+            raise ValueError(
+                'Requested number of samples is larger than the available {} samples.'.format(self.nsamples_total))
+        # incomplete averaging groups at the end are dropped
+        nrows = nframes // every
+        nframes = nrows * every
+        if not chunk_frames:
+            chunk_frames = 2 ** 22 // lframes
+        chunk_frames = max(every, chunk_frames // every * every)
+
+        nbins = self.get_nbins(lframes)
+        if filename:
+            zz = np.lib.format.open_memmap(
+                filename + '.npy', mode='w+', dtype=self.get_real_dtype(), shape=(nrows, nbins))
+        else:
+            zz = np.empty((nrows, nbins), dtype=self.get_real_dtype())
+
+        row = 0
+        for _, x in self.iter_chunks(chunk_frames * lframes, start=sframes * lframes, stop=(sframes + nframes) * lframes):
+            n = len(x) // lframes
+            pp = self.get_power_frames(x, n, lframes)
+            if every > 1:
+                pp = np.average(np.reshape(pp, (n // every, every, nbins)), axis=1)
+            zz[row:row + len(pp)] = pp
+            row += len(pp)
+
+        if filename:
+            zz.flush()
+
+        xx, yy = self.get_spectrogram_mesh(nrows, lframes, sparse=sparse)
+        # time of each row is the mean time of its averaged frames
+        yy = yy * every + yy.dtype.type((every - 1) / 2 * lframes / self.fs)
+        return xx, yy, zz
 
     def get_dp_p_vs_time(self, xx, yy, zz, eta):
         """Returns two arrays for plotting dp_p vs time
@@ -300,14 +774,11 @@ class IQBase(object):
             eta (float): _description_
 
         Returns:
-            (ndarray): Flattened array for 2D plot
+            (ndarray): Flattened array for 2D plot, NaN where no FWHM was found
         """        
-        # Slices parallel to frequency axis
-        n_time_frames = np.shape(xx)[0]
-        dp_p = np.zeros(n_time_frames)
-        for i in range(n_time_frames):
-            fwhm, f_peak, _, _, _ = IQBase.get_fwhm(xx[i, :], zz[i, :], skip=20)
-            dp_p[i] = fwhm / (f_peak + self.center) / eta
+        # all slices parallel to frequency axis at once
+        fwhm, f_peak, _, _ = IQBase.get_fwhm_rows(xx, zz, skip=20)
+        dp_p = fwhm / (f_peak + self.center) / eta
 
         # Flatten array for 2D plot
         return yy[:, 0], dp_p
@@ -319,19 +790,29 @@ class IQBase(object):
             xx (ndarray): Frequency meshgrid
             yy (ndarray): Time meshgrid
             zz (ndarray): Power meshgrid
-            eta (float): _description_
 
         Returns:
             (ndarray): Flattened array for 2D plot
         """        
-        # Slices parallel to frequency axis
-        n_time_frames = np.shape(xx)[0]
-        frame_power = np.zeros(n_time_frames)
-        for i in range(n_time_frames):
-            frame_power[i] = self.get_channel_power(xx[i, :], zz[i, :])
+        tt, power = self.get_band_power_vs_time(xx, yy, zz)
+        return tt, power[:, 0]
 
-        # Flatten array for 2D plot
-        return yy[:, 0], frame_power
+    def get_band_power_vs_time(self, xx, yy, zz, bands=None):
+        """Returns the channel power of several frequency bands for every time frame,
+        considering noise bandwidth as in get_channel_power
+
+        Args:
+            xx (ndarray): Frequency meshgrid
+            yy (ndarray): Time meshgrid
+            zz (ndarray): Power meshgrid
+            bands (list, optional): Pairs of lowest and highest frequency of each band, see get_band_sums. Defaults to None, i.e. the whole frame.
+
+        Returns:
+            (tuple): Time array and array of powers with shape (nframes, nbands)
+        """
+        # same noise bandwidth as in get_channel_power
+        nbw = self.rbw * 1.056
+        return yy[:, 0], IQBase.get_band_sums(xx, zz, bands) / nbw
 
     @staticmethod
     def get_frame_sum_vs_time(yy, zz):
@@ -344,10 +825,60 @@ class IQBase(object):
         Returns:
             (float): Sum
         """        
-        summ = np.zeros(np.shape(zz)[0])
-        for i in range(len(summ)):
-            summ[i] = np.sum(zz[i, :])
-        return yy[:, 0], summ
+        return yy[:, 0], IQBase.get_band_sums(None, zz)[:, 0]
+
+    @staticmethod
+    def get_band_indices(f, bands):
+        """Convert frequency bands to ranges of bins.
+
+        Args:
+            f (ndarray): Ascending frequencies of the bins
+            bands (list): Pairs of lowest and highest frequency of each band, both included. None instead of a pair means all bins.
+
+        Returns:
+            (ndarray): First and one after the last bin of each band, with shape (nbands, 2)
+        """
+        indices = np.empty((len(bands), 2), dtype=np.intp)
+        for i, band in enumerate(bands):
+            if band is None:
+                indices[i] = 0, len(f)
+            else:
+                indices[i] = np.searchsorted(f, band[0], side='left'), np.searchsorted(f, band[1], side='right')
+        # empty bands for reversed limits
+        indices[:, 1] = np.maximum(indices[:, 0], indices[:, 1])
+        return indices
+
+    @staticmethod
+    def get_band_sums(xx, zz, bands=None):
+        """Integrate the power of several frequency bands for every row in one pass over zz.
+        The rows are summed cumulatively, so the sum of each band is the difference of two
+        values, independent of the number of bands and their widths. Bands may overlap.
+
+        Args:
+            xx (ndarray): Frequency meshgrid, full or sparse, or an array of frequencies. Only needed for bands other than None.
+            zz (ndarray): Power meshgrid
+            bands (list, optional): Pairs of lowest and highest frequency of each band, both included. None instead of a pair means the whole row. Defaults to None, i.e. one band covering the whole row.
+
+        Returns:
+            (ndarray): Sums with shape (nrows, nbands)
+        """
+        nrows, nbins = np.shape(zz)
+        if bands is None:
+            bands = [None]
+        f = np.arange(nbins) if xx is None else np.atleast_2d(xx)[0]
+        indices = IQBase.get_band_indices(f, bands)
+
+        sums = np.empty((nrows, len(bands)))
+        csum = None
+        batch = max(1, BAND_BATCH_SAMPLES // nbins)
+        for start in range(0, nrows, batch):
+            block = zz[start:start + batch]
+            if csum is None or len(csum) != len(block):
+                csum = np.zeros((len(block), nbins + 1))
+            # accumulate in double precision, also for single precision spectrograms
+            np.cumsum(block, axis=1, out=csum[:, 1:])
+            np.subtract(csum[:, indices[:, 1]], csum[:, indices[:, 0]], out=sums[start:start + len(block)])
+        return sums
 
     @staticmethod
     def get_fwhm(f, p, skip=None):
@@ -392,6 +923,57 @@ class IQBase(object):
         # return watt values not dbm
         return fwhm, f_peak, np.array([index_m3db, index_p3db]), np.array([f_m3db, f_p3db]), np.array([p_m3db, p_p3db])
 
+    @staticmethod
+    def get_fwhm_rows(xx, zz, skip=None):
+        """Return the full width at half maximum of all rows of a spectrogram at once.
+        The -3 dB crossings are searched outwards from the peak of each row and
+        interpolated linearly in dB between the neighbouring bins.
+
+        Args:
+            xx (ndarray): Frequency meshgrid, or a frequency array for all rows
+            zz (ndarray): Power meshgrid
+            skip (int, optional): Sometimes peaks have a dip, skip this number of bins on both sides of the peak, use with care or visual inspection. Defaults to None.
+
+        Returns:
+            (tuple): Arrays of the FWHM, frequency and power of the peak and the frequencies of the lower and upper -3 dB crossings with shape (nrows, 2). NaN where no crossing was found.
+        """
+        zz = np.atleast_2d(zz)
+        ff = np.broadcast_to(xx, zz.shape)
+        nrows, nbins = zz.shape
+        rows = np.arange(nrows)
+        bins = np.arange(nbins)
+        skip = skip or 0
+
+        peak_index = zz.argmax(axis=1)
+        p_peak = zz[rows, peak_index]
+        f_peak = ff[rows, peak_index]
+        # -3 dB in Watts, so the conversion to dBm is only needed at the crossings
+        below = zz <= (p_peak * 10 ** -0.3)[:, np.newaxis]
+
+        f_edges = np.full((nrows, 2), np.nan)
+        for side, direction in enumerate((-1, 1)):
+            # bins on this side of the peak beyond the skipped ones
+            mask = below & (direction * (bins - peak_index[:, np.newaxis]) >= max(skip, 1))
+            if direction < 0:
+                index = nbins - 1 - mask[:, ::-1].argmax(axis=1)
+            else:
+                index = mask.argmax(axis=1)
+            found = mask[rows, index]
+            r, i = rows[found], index[found]
+            # the neighbour towards the peak is still above -3 dB, unless it was skipped
+            j = i - direction
+            p_i = IQBase.get_dbm(np.array(zz[r, i], dtype=np.float64))
+            p_j = IQBase.get_dbm(np.array(zz[r, j], dtype=np.float64))
+            p_3db = IQBase.get_dbm(np.array(p_peak[r], dtype=np.float64)) - 3
+            # without a neighbour above -3 dB the crossing is at the bin itself
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t = np.where(p_j > p_3db, (p_j - p_3db) / (p_j - p_i), 1)
+            t = np.clip(t, 0, 1)
+            f_edges[r, side] = ff[r, j] + t * (ff[r, i] - ff[r, j])
+
+        fwhm = f_edges[:, 1] - f_edges[:, 0]
+        return fwhm, f_peak, p_peak, f_edges
+
     @staticmethod
     def get_sigma_estimate(f, p):
         """Gets an estimate for sigma. Could be used for more precise fitting.
@@ -435,11 +1017,80 @@ class IQBase(object):
         Returns:
             (ndarray): ndarray of peaks and their indexes
         """        
-        # convert to dbm for convenience
-        p_dbm = IQBase.get_dbm(p)
-        peak_ind = find_peaks_cwt(p_dbm, np.arange(1, accuracy))
+        peaks = IQBase.get_peaks(f, p, distance=max(1, accuracy // 2))
         # return the watt value, not dbm
-        return np.array(f[peak_ind]), np.array(p[peak_ind])
+        return peaks.frequency, peaks.power
+
+    @staticmethod
+    def get_peaks(xx, zz, snr=6, prominence=3, distance=1, wlen=50):
+        """Find peaks in all rows of a spectrogram, or in a spectrum, at once. Peaks are local
+        maxima within distance bins, standing out of the noise floor of their row, i.e. its median,
+        by at least snr and out of their surroundings by at least prominence. The prominence is
+        taken within wlen bins on each side of the peak.
+
+        Args:
+            xx (ndarray): Frequency meshgrid, full or sparse, or an array of frequencies
+            zz (ndarray): Power meshgrid or an array of powers
+            snr (float, optional): Minimum height above the noise floor in [dB]. Defaults to 6.
+            prominence (float, optional): Minimum prominence in [dB]. Defaults to 3.
+            distance (int, optional): Peaks must be the maximum of this many bins on each side. Defaults to 1.
+            wlen (int, optional): Number of bins on each side for the prominence and the width. Defaults to 50.
+
+        Returns:
+            (numpy.recarray): Peaks with the fields row, bin, frequency, power and width in [Hz], sorted by row and bin
+        """
+        zz = np.atleast_2d(zz)
+        nrows, nbins = zz.shape
+        f = np.atleast_2d(xx)[0]
+        delta_f = abs(f[1] - f[0]) if nbins > 1 else 0.0
+        distance = max(1, int(distance))
+        wlen = max(distance, int(wlen))
+
+        parts = []
+        batch = max(1, PEAK_BATCH_SAMPLES // nbins)
+        for start in range(0, nrows, batch):
+            block = np.asarray(zz[start:start + batch], dtype=np.float64)
+            maxima = block == maximum_filter1d(block, 2 * distance + 1, axis=1, mode='nearest')
+            # plateaus only count once, at their first bin
+            maxima[:, 1:] &= block[:, 1:] != block[:, :-1]
+            floor = np.median(block, axis=1, keepdims=True)
+            maxima &= block > floor * 10 ** (snr / 10)
+            # lowest values within wlen on the left and on the right, the higher one is the base
+            right = minimum_filter1d(block, wlen + 1, axis=1, mode='nearest', origin=-((wlen + 1) // 2))
+            left = minimum_filter1d(block[:, ::-1], wlen + 1, axis=1, mode='nearest',
+                                    origin=-((wlen + 1) // 2))[:, ::-1]
+            base = np.maximum(left, right)
+            maxima &= block > base * 10 ** (prominence / 10)
+
+            rows, bins = np.nonzero(maxima)
+            peaks = np.empty(len(rows), dtype=PEAK_TYPE)
+            peaks['row'] = rows + start
+            peaks['bin'] = bins
+            peaks['frequency'] = f[bins]
+            peaks['power'] = block[rows, bins]
+            peaks['width'] = IQBase._get_peak_widths(block, rows, bins, base[rows, bins], wlen) * delta_f
+            parts.append(peaks)
+
+        return np.concatenate(parts or [np.empty(0, dtype=PEAK_TYPE)]).view(np.recarray)
+
+    @staticmethod
+    def _get_peak_widths(block, rows, bins, base, wlen):
+        # full width at half prominence in bins, interpolated between the bins around the crossings
+        nbins = block.shape[1]
+        level = (block[rows, bins] + base) / 2
+        steps = np.arange(wlen + 1)
+        width = np.zeros(len(rows))
+        for direction in (-1, 1):
+            idx = np.clip(bins[:, np.newaxis] + direction * steps, 0, nbins - 1)
+            values = block[rows[:, np.newaxis], idx]
+            # the base is within wlen, so the level is crossed on both sides
+            k = np.maximum(np.argmax(values <= level[:, np.newaxis], axis=1), 1)
+            inner = values[np.arange(len(rows)), k - 1]
+            outer = values[np.arange(len(rows)), k]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t = np.where(inner > outer, (inner - level) / (inner - outer), 1)
+            width += k - 1 + np.clip(t, 0, 1)
+        return width
 
     @staticmethod
     def get_broad_peak_dbm(f, p):
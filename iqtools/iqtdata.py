@@ -6,15 +6,31 @@ xaratustrah@github Aug-2015
 
 """
 
+import os
 import logging as log
 import numpy as np
 from .iqbase import IQBase
 
 
+# each frame starts with this header followed by the Q and I values
+FRAME_HEADER_TYPE = np.dtype(
+    {'names': ['reserved1', 'validA', 'validP', 'validI', 'validQ', 'bins', 'reserved2', 'triggered',
+               'overLoad', 'lastFrame', 'ticks'],
+     'formats': [np.int16, np.int16, np.int16, np.int16, np.int16, np.int16, np.int16,
+                 np.int16, np.int16, np.int16, np.int32]})
+
+
 class IQTData(IQBase):
-    def __init__(self, filename):
+    header_fields = ('fft_points', 'max_input_level', 'level_offset', 'frame_length', 'gain_offset',
+                     'center', 'span', 'nframes_tot', 'date_time', 'nsamples_total', 'fs', 'scale',
+                     'data_offset')
+
+    def __init__(self, filename, use_mmap=True):
         super().__init__(filename)
 
+        # access the frames through a memory map instead of reading them
+        self.use_mmap = use_mmap
+
         # Additional fields in this subclass
         self.header = ''
         self.span = 0
@@ -24,6 +40,13 @@ class IQTData(IQBase):
         self.gain_offset = 0
         self.max_input_level = 0
         self.scale = 0
+        self.nframes_tot = 0
+        self.date_time = ''
+        self.data_offset = 0
+
+        if not self.load_indexed_header():
+            self.parse_header()
+            self.store_indexed_header()
 
     def read(self, nframes=10, lframes=1024, sframes=0):
         """Read a section of the file.
@@ -33,9 +56,100 @@ class IQTData(IQBase):
             lframes (int, optional): Length of each frame. Defaults to 1024.
             sframes (int, optional): Starting frame. Defaults to 0.
         """        
-        # in iqt files, lframes is always fixed 1024 at the time of reading the file.
+        # in iqt files, the frames on disk are always fft_points long, usually 1024.
         # At the usage time, the lframe can be changed from time data
+        self.read_samples(nframes * lframes, offset=sframes * lframes)
+
+    def read_samples(self, nsamples, offset=0):
+        """Read samples. Only the frames covering the requested range are read, their
+        headers are dropped.
+
+        Args:
+            nsamples (int): Number of samples to read from file
+            offset (int, optional): Starting sample. Defaults to 0.
+
+        Raises:
+            ValueError: Raises if the requested number of samples is larger than available
+        """
+        if nsamples > self.nsamples_total - offset:
+            raise ValueError(
+                'Requested number of samples is larger than the available {} samples.'.format(self.nsamples_total))
+
+        first_frame = offset // self.fft_points
+        last_frame = -(-(offset + nsamples) // self.fft_points)
+
+        if self.use_mmap:
+            frames = self.get_memmap()[first_frame:last_frame]
+        else:
+            frame_type = self.get_frame_type()
+            try:
+                with open(self.filename, 'rb') as f:
+                    f.seek(self.data_offset + first_frame * frame_type.itemsize)
+                    ba = f.read((last_frame - first_frame) * frame_type.itemsize)
+            except:
+                log.error('File seems to end here!')
+                return
+            frames = np.frombuffer(ba, dtype=frame_type)
+
+        if len(frames) < last_frame - first_frame:
+            log.error('File seems to end here!')
+            return
+
+        self.data_array = self.get_iq(frames, nsamples, offset - first_frame * self.fft_points,
+                                      np.empty(nsamples, dtype=self.dtype))
+        # todo: correction data block
 
+    def get_iq(self, frames, nsamples, start, out):
+        """Decode consecutive frames into a complex valued array. The Q and I columns are
+        swapped and scaled in a single pass.
+
+        Args:
+            frames (ndarray): Frames as read with the type of get_frame_type
+            nsamples (int): Number of samples
+            start (int): Starting sample within the first frame
+            out (ndarray): Complex valued array of length nsamples to be filled
+
+        Returns:
+            (ndarray): out
+        """
+        # 2 byte integer for Q, 2 byte integer for I
+        qi = frames['data'].reshape(-1, 2)[start:start + nsamples]
+        return self.scale_iq(qi[:, ::-1], self.scale, out)
+
+    def get_frame_type(self):
+        """Type of a frame on disk, a header followed by fft_points pairs of Q and I values.
+
+        Returns:
+            (numpy.dtype): Structured type with the fields header and data
+        """
+        return np.dtype([('header', FRAME_HEADER_TYPE), ('data', '<i2', 2 * self.fft_points)])
+
+    def get_memmap(self):
+        """Map the frames after the header into memory. Nothing is read from disk until the
+        returned array is sliced, so frames can be accessed randomly.
+
+        Returns:
+            (numpy.memmap): Read-only array of frames with the fields header and data
+        """
+        frame_type = self.get_frame_type()
+        # file might have the correct size, but the data not copied fully
+        nframes = min(self.nframes_tot,
+                      (os.path.getsize(self.filename) - self.data_offset) // frame_type.itemsize)
+        return np.memmap(self.filename, dtype=frame_type, mode='r',
+                         offset=self.data_offset, shape=(nframes,))
+
+    def _open_chunk_source(self):
+        return self.get_memmap()
+
+    def _read_chunk(self, source, offset, out):
+        first_frame = offset // self.fft_points
+        last_frame = -(-(offset + len(out)) // self.fft_points)
+        self.get_iq(source[first_frame:last_frame], len(out),
+                    offset - first_frame * self.fft_points, out)
+
+    def parse_header(self):
+        """Parse the ASCII header in front of the frames and remember where the frames start.
+        """
         data_offset = 0
         with open(self.filename, 'rb') as f:
             ba = f.read(1)
@@ -47,6 +161,7 @@ class IQTData(IQBase):
             ba = f.read(header_size)
             data_offset += header_size
 
+        self.data_offset = data_offset
         self.header = ba.decode('utf8').split('\n')
         header_dic = self.read_header(self.header)
 
@@ -66,47 +181,6 @@ class IQTData(IQBase):
         self.scale = np.sqrt(np.power(
             10, (self.gain_offset + self.max_input_level + self.level_offset) / 10) / 20 * 2)
 
-        log.info("Proceeding to read binary section, 32bit (4 byte) little endian.")
-
-        frame_header_type = np.dtype(
-            {'names': ['reserved1', 'validA', 'validP', 'validI', 'validQ', 'bins', 'reserved2', 'triggered',
-                       'overLoad', 'lastFrame', 'ticks'],
-             'formats': [np.int16, np.int16, np.int16, np.int16, np.int16, np.int16, np.int16,
-                         np.int16, np.int16, np.int16, np.int32]})
-
-        # 2 byte integer for Q, 2 byte integer for I
-        frame_data_type = np.dtype((np.int16, 2 * lframes))
-        frame_type = np.dtype({'names': ['header', 'data'],
-                               'formats': [(frame_header_type, 1), (frame_data_type, 1)]})
-
-        total_n_bytes = nframes * frame_type.itemsize
-        start_n_bytes = sframes * frame_type.itemsize
-
-        # prepare an empty array with enough room
-        self.data_array = np.zeros(lframes * nframes, np.complex64)
-
-        # Read n frames at once
-        try:
-            with open(self.filename, 'rb') as f:
-                f.seek(data_offset + start_n_bytes)
-                ba = f.read(total_n_bytes)
-        except:
-            log.error('File seems to end here!')
-            return
-
-        # print(len(ba))
-        frame_array = np.fromstring(ba, dtype=frame_type)
-
-        for i in range(frame_array.size):
-            temp_array = np.zeros(2 * lframes, np.int16)
-            temp_array[::2], temp_array[1::2] = frame_array[i]['data'][1::2], frame_array[i]['data'][::2]
-            temp_array = temp_array.astype(np.float32)
-            temp_array = temp_array.view(np.complex64)
-            self.data_array[i * lframes:(i + 1) * lframes] = temp_array
-        # and finally scale the data
-        self.data_array = self.data_array * self.scale
-        # todo: correction data block
-
     # def read_iq(self, nframes=10, lframes=1024, sframes=1):
     #     """
     #     Read Sony/Tektronix IQ Files
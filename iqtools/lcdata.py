@@ -11,9 +11,13 @@ an old code by M. Hausmann from 1992
 import numpy as np
 import struct
 import datetime
+import time
 import os
 from .iqbase import IQBase
 
+# all fields read from the wave descriptor are within these first bytes
+HEADER_READ_SIZE = 346
+
 
 class LCData(IQBase):
     def __init__(self, filename):
@@ -25,6 +29,12 @@ class LCData(IQBase):
 
         # Additional fields in this subclass
         self.date_time = time.ctime(os.path.getctime(self.filename))
+        self.data_offset = 0
+        self.vert_gain = 1.0
+        self.vert_offset = 0.0
+
+        # only the header is read here, samples are read on demand
+        self.read_header()
 
     def read(self, nframes=10, lframes=1024, sframes=0):
         """Read a section of the file.
@@ -37,16 +47,72 @@ class LCData(IQBase):
 
         self.read_samples(nframes * lframes, offset=sframes * lframes)
 
+    def read_samples(self, nsamples, offset=0):
+        """Read samples. Only the requested range is read from the memory map and
+        converted to Volts.
+
+        Args:
+            nsamples (int): Number of samples to read from file
+            offset (int, optional): Starting sample. Defaults to 0.
+
+        Raises:
+            ValueError: Raises if the requested number of samples is larger than available
+        """
+        if nsamples > self.nsamples_total - offset:
+            raise ValueError(
+                'Requested number of samples is larger than the available {} samples.'.format(self.nsamples_total))
+
+        self.data_array = self.get_volts(self.get_memmap()[offset:offset + nsamples],
+                                         np.empty(nsamples, dtype=self.get_real_dtype()))
+
+    def get_volts(self, raw, out):
+        """Convert raw values to Volts in a single pass.
+
+        Args:
+            raw (ndarray): Raw values as sliced from get_memmap
+            out (ndarray): Array of the same length to be filled
+
+        Returns:
+            (ndarray): out
+        """
+        out[:] = raw
+        out *= self.vert_gain
+        out -= self.vert_offset
+        return out
+
+    def get_memmap(self):
+        """Map the samples after the header into memory. Nothing is read from disk until
+        the returned array is sliced. The values are raw, i.e. not scaled.
+
+        Returns:
+            (numpy.memmap): Read-only array of bytes
+        """
+        return np.memmap(self.filename, dtype=np.int8, mode='r',
+                         offset=self.data_offset, shape=(self.nsamples_total,))
+
+    def _open_chunk_source(self):
+        return self.get_memmap()
+
+    def _read_chunk(self, source, offset, out):
+        # the trace is real valued, the imaginary part stays zero
+        out.imag = 0
+        self.get_volts(source[offset:offset + len(out)], out.real)
+
     def read_complete_file(self):
         """Reads a complete file.
 
         Returns:
             ndarray: Returns the complete data array
         """        
+        self.read_samples(self.nsamples_total)
+        return self.data_array
 
+    def read_header(self):
+        """Parse the wave descriptor at the beginning of the file.
+        """
         filesize = os.path.getsize(self.filename)
         with open(self.filename, 'rb') as f:
-            file_data = f.read()
+            file_data = f.read(HEADER_READ_SIZE)
         # 45th byte determines the endianness
         # one = little endian
         biglit = ''
@@ -57,8 +123,10 @@ class LCData(IQBase):
 
         hdr_len = struct.unpack_from(
             '{}I'.format(biglit), file_data, 47)[0] + 11
-        self.nsamples_total = struct.unpack_from(
-            '{}I'.format(biglit), file_data, 71)[0]
+        self.data_offset = hdr_len
+        # file might have the correct size, but the data not copied fully
+        self.nsamples_total = min(struct.unpack_from(
+            '{}I'.format(biglit), file_data, 71)[0], filesize - hdr_len)
 
         self.vert_gain = struct.unpack_from(
             '{}f'.format(biglit), file_data, 167)[0]
@@ -82,10 +150,6 @@ class LCData(IQBase):
         except ValueError:
             self.date_time = ''
 
-        self.data_array = np.frombuffer(
-            file_data, np.int8, offset=hdr_len) * self.vert_gain
-        return self.data_array
-
 
 # ------------------------
 
@@ -6,9 +6,17 @@ xaratustrah@github Jul-2022
 """
 
 import os
+from functools import lru_cache
 import numpy as np
+from scipy.signal import firwin, upfirdn
 from .iqbase import IQBase
 
+# the first block is the header, each following block holds 8178 samples and a 28 byte footer
+BLOCK_SIZE = 2 ** 14
+BLOCK_NSAMPLES = 8178
+BLOCK_TYPE = np.dtype([('data', '<i2', BLOCK_NSAMPLES),
+                       ('footer', np.uint8, BLOCK_SIZE - 2 * BLOCK_NSAMPLES)])
+
 
 class R3FData(IQBase):
     def __init__(self, filename):
@@ -18,12 +26,16 @@ class R3FData(IQBase):
         self.date_time = ''
         self.center = 0.0
         self.acq_bw = 0.0
-        
-        self.read_header()
-        self.cplx_adc_data = self.read_all_blocks()
 
+        # sampling rate and number of samples of the ADC, fs and nsamples_total change with the decimation
+        self.adc_fs = 0.0
+        self.adc_nsamples = 0
+        self.decimation = 1
+        self.fir_taps = None
+
+        # only the header is read here, samples are decoded on demand
+        self.read_header()
 
-    
     def read(self, nframes=10, lframes=1024, sframes=0):
         """Read a section of the file.
 
@@ -31,66 +43,165 @@ class R3FData(IQBase):
             nframes (int, optional): Number of frames to be read. Defaults to 10.
             lframes (int, optional): Length of each frame. Defaults to 1024.
             sframes (int, optional): Starting frame. Defaults to 0.
-        """        
+        """
         self.read_samples(nframes * lframes, offset=sframes * lframes)
 
     def read_samples(self, nsamples, offset=0):
-        """Reads a certain number of samples
+        """Reads a certain number of samples. Only the blocks covering the requested
+        range are read and decoded.
 
         Args:
             nsamples (int): Number of samples to read
-            offset (int, optional): Starting frame. Defaults to 0.
-        """        
-        self.data_array = self.cplx_adc_data[offset : offset + nsamples]
-    
-    
+            offset (int, optional): Starting sample. Defaults to 0.
+
+        Raises:
+            ValueError: Raises if the requested number of samples is larger than available
+        """
+        if nsamples > self.nsamples_total - offset:
+            raise ValueError(
+                'Requested number of samples is larger than the available {} samples.'.format(self.nsamples_total))
+
+        self.data_array = self.get_samples(nsamples, offset)
+
+    def set_bandwidth(self, bandwidth=None, ntaps=None):
+        """Low pass filter and decimate the down converted signal to the given bandwidth.
+        The decimation factor is the largest integer keeping the bandwidth, fs and
+        nsamples_total are changed accordingly.
+
+        Args:
+            bandwidth (float, optional): Bandwidth in [Hz]. Defaults to None, i.e. no filtering and decimation.
+            ntaps (int, optional): Number of taps of the FIR filter. Defaults to None, i.e. 16 per decimation step.
+        """
+        if bandwidth is None or bandwidth >= self.adc_fs:
+            self.decimation = 1
+            self.fir_taps = None
+        else:
+            self.decimation = int(self.adc_fs // bandwidth)
+            # odd number of taps, so the filter has an integer delay
+            ntaps = (ntaps or 16 * self.decimation) // 2 * 2 + 1
+            self.fir_taps = firwin(ntaps, bandwidth / 2, fs=self.adc_fs)
+        self.fs = self.adc_fs / self.decimation
+        self.nsamples_total = self.adc_nsamples // self.decimation
+
+    def get_samples(self, nsamples, offset=0, blocks=None, out=None):
+        """Decode a range of samples from the blocks covering it.
+
+        Args:
+            nsamples (int): Number of samples
+            offset (int, optional): Starting sample. Defaults to 0.
+            blocks (numpy.memmap, optional): Mapped blocks as returned by get_memmap. Defaults to None, i.e. mapped here.
+            out (ndarray, optional): Array of length nsamples to write the samples into. Defaults to None.
+
+        Returns:
+            numpy.ndarray: Complex valued samples
+        """
+        if blocks is None:
+            blocks = self.get_memmap()
+        if self.decimation == 1:
+            return self.downconvert(self.get_adc_range(blocks, nsamples, offset), offset, out=out)
+
+        # the centered filter needs half of its length on both sides of the decimated range
+        half = len(self.fir_taps) // 2
+        skip = -(-(len(self.fir_taps) - 1) // self.decimation)
+        start = offset * self.decimation + half - skip * self.decimation
+        stop = (offset + nsamples - 1) * self.decimation + half + 1
+        first = max(start, 0)
+        last = min(stop, self.adc_nsamples)
+        x = self.downconvert(self.get_adc_range(blocks, last - first, first), first)
+        # beyond the ends of the file the first and last samples are repeated
+        x = np.pad(x, (first - start, stop - last), mode='edge')
+        y = upfirdn(self.fir_taps.astype(self.get_real_dtype()), x, down=self.decimation)
+        if out is None:
+            return y[skip:skip + nsamples].astype(self.dtype, copy=False)
+        out[:] = y[skip:skip + nsamples]
+        return out
+
+    def get_memmap(self):
+        """Map the blocks after the header into memory. Nothing is read from disk until the
+        returned array is sliced.
+
+        Returns:
+            (numpy.memmap): Read-only array of blocks with the fields data and footer
+        """
+        return np.memmap(self.filename, dtype=BLOCK_TYPE, mode='r',
+                         offset=BLOCK_SIZE, shape=(self.nblocks,))
+
+    @staticmethod
+    def get_adc_range(blocks, nsamples, offset):
+        """Slice a range of ADC samples out of the mapped blocks. Only the blocks covering
+        the range are touched, their footers are dropped.
+
+        Args:
+            blocks (numpy.memmap): Mapped blocks as returned by get_memmap
+            nsamples (int): Number of samples
+            offset (int): Starting sample
+
+        Returns:
+            (ndarray): Little endian 16 bit ADC values
+        """
+        first_block = offset // BLOCK_NSAMPLES
+        last_block = -(-(offset + nsamples) // BLOCK_NSAMPLES)
+        start = offset - first_block * BLOCK_NSAMPLES
+        return blocks['data'][first_block:last_block].reshape(-1)[start:start + nsamples]
+
+    def downconvert(self, adc, offset, out=None):
+        """Mix real ADC samples down to base band. The LO sin + j cos of the center frequency is
+        taken from a lookup table and the phase at the offset, so it is continuous between chunks.
+
+        Args:
+            adc (ndarray): ADC samples
+            offset (int): Number of the first ADC sample since the beginning of the file
+            out (ndarray, optional): Contiguous array of the same length to write the samples into. Defaults to None.
+
+        Returns:
+            (ndarray): Complex valued samples
+        """
+        table = get_nco_table(self.center / self.adc_fs, BLOCK_NSAMPLES)
+        n = len(adc)
+        if out is None:
+            out = np.empty(n, dtype=self.dtype)
+        nrows, rest = divmod(n, len(table))
+        # sin(wn) + j cos(wn) = j exp(-jwn), the rows continue the phase of the table
+        row_starts = offset + len(table) * np.arange(nrows + 1)
+        row_phases = np.exp(-2j * np.pi * np.mod(row_starts * (self.center / self.adc_fs), 1))
+        np.multiply(row_phases[:nrows, np.newaxis], table,
+                    out=out[:nrows * len(table)].reshape(nrows, len(table)))
+        np.multiply(row_phases[nrows], table[:rest], out=out[nrows * len(table):])
+        out *= adc
+        return out
+
+    def _open_chunk_source(self):
+        return self.get_memmap()
+
+    def _read_chunk(self, source, offset, out):
+        self.get_samples(len(out), offset, blocks=source, out=out)
+
     def read_all_blocks(self):
         """Reads all data blocks at once
 
         Returns:
             numpy.ndarray: Complex valued block
-        """        
+        """
         return self.read_blocks(self.nblocks)
 
-        
-    def read_blocks(self, nblocks=1):
+    def read_blocks(self, nblocks=1, first_block=0):
         """Reads a number of data blocks. Each block contains 8178 samples each 2 bytes + an additional 28
         byte footer making a total size of 16384, since fs is fixed to 112msps, each block will
         be ca. 73us long
 
         Args:
             nblocks (int, optional): Number of blocks to read. Defaults to 1.
+            first_block (int, optional): First block to read, counting from 0 after the header. Defaults to 0.
 
         Returns:
             numpy.ndarray: Complex valued block
-        """        
-       
-        adc_data = np.zeros(nblocks * 8178)
-        f = open(self.filename, 'rb')
-        f.seek(16384) # jump header
-        for ii in range(nblocks):
-            #print(ii)
-            ba = f.read(16384)
-            # 16 bit signed integer little endian
-            # since we divide 16384 by 2, then we ignore the last 14 not 28
-            adc_data[ii * 8178 : (ii+1) * 8178] = np.frombuffer(ba, dtype='<i2')[:-14]
-        
-        size = len(adc_data)
-        xaxis = np.linspace(0,size * 1/self.fs, size)
-        lo_i = np.sin(self.center * (2*np.pi) * xaxis)
-        lo_q = np.cos(self.center * (2*np.pi)* xaxis)
-        del(xaxis)
-        ii = adc_data * lo_i
-        qq = adc_data * lo_q
-        del(lo_i)
-        del(lo_q)
-        c = np.reshape(np.concatenate((ii, qq)), (2, -1)).T
-        result = 1j*c[...,1]; result += c[...,0]
-        return result
+        """
+        adc_data = self.get_memmap()[first_block:first_block + nblocks]['data'].reshape(-1)
+        return self.downconvert(adc_data, first_block * BLOCK_NSAMPLES)
 
     def read_header(self):
         """Reads the header and sets the value in the objects.
-        """          
+        """
         size = os.path.getsize(self.filename)
 
         # file size must be multiple integer of 16384
@@ -100,20 +211,37 @@ class R3FData(IQBase):
         self.nblocks = int(size / 2**14) - 1
 
         self.nsamples_total = self.nblocks * 8178
+        self.adc_nsamples = self.nsamples_total
 
         f = open(self.filename, 'rb')
-        
+
         f.seek(1024)
         ref_level = np.frombuffer(f.read(8), dtype='<f8')[0] # dBm
         self.center = np.frombuffer(f.read(8), dtype='<f8')[0] # Hz
-        
+
         f.seek(2048 + 4+ 6*4 + 8)
         self.fs = np.frombuffer(f.read(8), dtype='<f8')[0] # samples / s
+        self.adc_fs = self.fs
         self.acq_bw = np.frombuffer(f.read(8), dtype='<f8')[0]
         f.seek(2048 + 4 + 6*4 + 8 + 8 + 8 + 4 + 4 + 7*4 + 8 + 8 + 7* 4 + 4 + 8)
-        
+
         dt = np.frombuffer(f.read(7 * 4), dtype='<i4')
         self.date_time = f'{dt[0]}y{dt[1]}m{dt[2]}d{dt[3]}h{dt[4]}m{dt[5]}s{dt[6]}'
         f.close()
-        
-        
\ No newline at end of file
+
+
+@lru_cache(maxsize=4)
+def get_nco_table(ratio, length):
+    """Lookup table of the LO sin + j cos for the first samples, cached since it only
+    depends on the ratio of center and sampling frequency.
+
+    Args:
+        ratio (float): Center frequency divided by the sampling frequency
+        length (int): Length of the table
+
+    Returns:
+        (ndarray): Read-only complex valued table
+    """
+    table = 1j * np.exp(-2j * np.pi * np.mod(ratio * np.arange(length), 1))
+    table.flags.writeable = False
+    return table
@@ -11,6 +11,20 @@ import logging as log
 import numpy as np
 from .iqbase import IQBase
 
+BLOCK_HEADER_SIZE = 88
+BLOCK_DATA_SIZE = 2 ** 17
+BLOCK_SIZE = BLOCK_HEADER_SIZE + BLOCK_DATA_SIZE
+# 4 bytes per sample, 2 for I and 2 for Q
+BLOCK_NSAMPLES = BLOCK_DATA_SIZE // 4
+# each file contains 15625 blocks
+FILE_NBLOCKS = 15625
+
+# a block on disk: TFP time stamp, PIO, scalers and then the big endian 16 bit I and Q values
+BLOCK_TYPE = np.dtype([('tfp', np.uint8, 12),
+                       ('pio', np.uint8, 12),
+                       ('scalers', np.uint8, 64),
+                       ('data', '>i2', 2 * BLOCK_NSAMPLES)])
+
 
 class TCAPData(IQBase):
     def __init__(self, filename, header_filename):
@@ -66,96 +80,100 @@ class TCAPData(IQBase):
             offset (int, optional): Starting sample. Defaults to 0.
         """        
 
-        BLOCK_HEADER_SIZE = 88
-        BLOCK_DATA_SIZE = 2 ** 17
-        BLOCK_SIZE = BLOCK_HEADER_SIZE + BLOCK_DATA_SIZE
-
         filesize = os.path.getsize(self.filename)
         # each file contains 15625 blocks
-        if not filesize == 15625 * BLOCK_SIZE:
+        if not filesize == FILE_NBLOCKS * BLOCK_SIZE:
             log.info(
                 "File size does not match block sizes times total number of blocks. Aborting...")
             return
 
-        # read header section
-        with open(self.filename, 'rb') as f:
-            tfp = f.read(12)
-            pio = f.read(12)
-            scalers = f.read(64)
+        blocks = self.get_memmap()
 
-        self.date_time = self.parse_tcap_tfp(tfp)
-        self.tcap_pio = pio
-        self.tcap_scalers = scalers
+        # header section of the first block
+        self.date_time = self.parse_tcap_tfp(blocks[0]['tfp'].tobytes())
+        self.tcap_pio = blocks[0]['pio'].tobytes()
+        self.tcap_scalers = blocks[0]['scalers'].tobytes()
 
-        data_section_size = self.frame_size - BLOCK_HEADER_SIZE
-        n_iq_samples = data_section_size / 2 / 2  # two bytes for I and two bytes for Q
-        self.nsamples_total = self.segment_blocks * n_iq_samples
+        if offset + nsamples > FILE_NBLOCKS * BLOCK_NSAMPLES:
+            raise ValueError(
+                'Requested number of samples is larger than the available {} samples.'.format(FILE_NBLOCKS * BLOCK_NSAMPLES))
 
-        # 4 comes from 2 times 2 byte integer for I and Q
-        total_n_bytes = 4 * nsamples
-        start_n_bytes = 4 * offset
+        iq = self.get_iq_range(blocks, nsamples, offset)
 
-        ba = bytearray()
-        try:
-            with open(self.filename, 'rb') as f:
-                f.seek(BLOCK_HEADER_SIZE + start_n_bytes)
-                for i in range(total_n_bytes):
-                    if not f.tell() % BLOCK_SIZE:
-                        log.info(
-                            'File pointer before jump: {}'.format(f.tell()))
-                        log.info(
-                            "Reached end of block {}. Now skipoing header of block {}!".format(
-                                int(f.tell() / BLOCK_SIZE),
-                                int(
-                                    f.tell() / BLOCK_SIZE) + 1))
-                        f.seek(88, 1)
-                        log.info('File pointer after jump: {}'.format(f.tell()))
-                    # using bytearray.extend is much faster than using +=
-                    ba.extend(f.read(1))
-        except:
-            log.error('File seems to end here!')
-            return
+        # big endian 16 bit for I and 16 bit for Q
+        self.data_array = self.scale_iq(iq, self.scale, np.empty(len(iq), dtype=self.dtype))
 
-        log.info('Total bytes read: {}'.format(len(ba)))
+    def get_memmap(self):
+        """Map the file into memory as an array of blocks. Nothing is read from disk
+        until the returned array is sliced.
 
-        # big endian 16 bit for I and 16 bit for Q
-        self.data_array = np.frombuffer(ba, '>i2')
-        self.data_array = self.data_array.astype(np.float32)
-        self.data_array = self.data_array * self.scale
-        self.data_array = self.data_array.view(np.complex64)
+        Returns:
+            (numpy.memmap): Read-only array of blocks with the fields tfp, pio, scalers and data
+        """
+        nblocks = os.path.getsize(self.filename) // BLOCK_SIZE
+        return np.memmap(self.filename, dtype=BLOCK_TYPE, mode='r', shape=(nblocks,))
+
+    def get_iq_range(self, blocks, nsamples, offset):
+        """Slice a range of samples out of the mapped blocks. Only the blocks covering the
+        range are touched, their headers are dropped.
+
+        Args:
+            blocks (numpy.memmap): Mapped blocks as returned by get_memmap
+            nsamples (int): Number of samples
+            offset (int): Starting sample
+
+        Returns:
+            (ndarray): Raw big endian 16 bit I and Q values with shape (nsamples, 2)
+        """
+        first_block = offset // BLOCK_NSAMPLES
+        last_block = -(-(offset + nsamples) // BLOCK_NSAMPLES)
+        start = offset - first_block * BLOCK_NSAMPLES
+        log.info('Total blocks read: {}'.format(last_block - first_block))
+        return blocks['data'][first_block:last_block].reshape(-1, 2)[start:start + nsamples]
+
+    def _open_chunk_source(self):
+        return self.get_memmap()
+
+    def _read_chunk(self, source, offset, out):
+        self.scale_iq(self.get_iq_range(source, len(out), offset), self.scale, out)
 
     def read_block(self, block_no):
         """
         Read the specified block between 1 and 15625.
         """
-        BLOCK_HEADER_SIZE = 88
-        BLOCK_DATA_SIZE = 2 ** 17
-        BLOCK_SIZE = BLOCK_HEADER_SIZE + BLOCK_DATA_SIZE
-
         try:
-            with open(self.filename, 'rb') as f:
-                f.seek((block_no - 1) * BLOCK_SIZE)
-                tfp = f.read(12)
-                pio = f.read(12)
-                scalers = f.read(64)
-                ba = f.read(131072)
-        except:
+            block = self.get_memmap()[block_no - 1]
+        except IndexError:
             log.error('File seems to end here!')
             return
 
-        self.date_time = self.parse_tcap_tfp(tfp)
-        self.tcap_pio = pio
-        self.tcap_scalers = scalers
+        self.date_time = self.parse_tcap_tfp(block['tfp'].tobytes())
+        self.tcap_pio = block['pio'].tobytes()
+        self.tcap_scalers = block['scalers'].tobytes()
 
-        log.info('Total bytes read: {}'.format(len(ba)))
+        log.info('Total bytes read: {}'.format(BLOCK_DATA_SIZE))
 
         # big endian 16 bit for I and 16 bit for Q
-        self.data_array = np.frombuffer(ba, '>i2')
-        self.data_array = self.data_array.astype(np.float32)
-        self.data_array = self.data_array * self.scale
-        self.data_array = self.data_array.view(np.complex64)
+        self.data_array = self.scale_iq(block['data'].reshape(-1, 2), self.scale,
+                                        np.empty(BLOCK_NSAMPLES, dtype=self.dtype))
         return self.data_array
 
+    def read_block_headers(self, first_block=1, nblocks=None):
+        """Read the headers of consecutive blocks without touching their data.
+
+        Args:
+            first_block (int, optional): First block between 1 and 15625. Defaults to 1.
+            nblocks (int, optional): Number of blocks. Defaults to None, i.e. up to the end of the file.
+
+        Returns:
+            (tuple): Arrays of TFP time stamps, PIO bytes with shape (nblocks, 12) and scaler bytes with shape (nblocks, 64)
+        """
+        blocks = self.get_memmap()
+        if nblocks is None:
+            nblocks = len(blocks) - first_block + 1
+        headers = blocks[first_block - 1:first_block - 1 + nblocks]
+        return self.parse_tcap_tfp_array(headers['tfp']), np.array(headers['pio']), np.array(headers['scalers'])
+
     def get_frame(self, first, second):
         """Make a frame by connecting two blocks
 
@@ -166,7 +184,7 @@ class TCAPData(IQBase):
         Returns:
             array: Connected frames
         """        
-        array = np.zeros(2 * 32768, dtype=np.complex64)
+        array = np.zeros(2 * 32768, dtype=self.dtype)
         array[0:32768] = self.read_block(first)
         array[32768:] = self.read_block(second)
         return array
@@ -247,6 +265,30 @@ class TCAPData(IQBase):
                                microseconds) + datetime.timedelta(days - 1)
         return ts.strftime('%Y-%m-%d %H:%M:%S')
 
+    def parse_tcap_tfp_array(self, tfp):
+        """Vectorized version of parse_tcap_tfp for the TFP headers of many blocks at once.
+
+        Args:
+            tfp (ndarray): Array of TFP headers with shape (nblocks, 12)
+
+        Returns:
+            (ndarray): Time stamps as numpy datetime64 with microsecond resolution
+        """
+        tfp = np.asarray(tfp, dtype=np.int64)
+        hi = (tfp >> 4) & 0x0f
+        lo = tfp & 0x0f
+
+        days = lo[:, 3] * 100 + hi[:, 4] * 10 + lo[:, 4]
+        hours = hi[:, 5] * 10 + lo[:, 5]
+        minutes = hi[:, 6] * 10 + lo[:, 6]
+        seconds = hi[:, 7] * 10 + lo[:, 7]
+        # down to 1E-6 seconds
+        microseconds = (hi[:, 8] * 100000 + lo[:, 8] * 10000 + hi[:, 9] * 1000 +
+                        lo[:, 9] * 100 + hi[:, 10] * 10 + lo[:, 10])
+
+        year = np.datetime64(self.file_basename[0:4], 'us')
+        return year + (((((days - 1) * 24 + hours) * 60 + minutes) * 60 + seconds) * 1000000 + microseconds).astype('m8[us]')
+
     def read_header(self):
         """Parses text header part.
 
@@ -268,4 +310,8 @@ class TCAPData(IQBase):
         self.decimation = int(dic['decimation'])
         self.trigger_time = float(dic['trigger_time'])
         self.segment_blocks = int(dic['segment_blocks'])
+
+        data_section_size = self.frame_size - BLOCK_HEADER_SIZE
+        n_iq_samples = data_section_size // 2 // 2  # two bytes for I and two bytes for Q
+        self.nsamples_total = self.segment_blocks * n_iq_samples
         return dic
@@ -8,14 +8,47 @@ xaratustrah@github Aug-2015
 
 import os
 import time
+import struct
 import logging as log
+from collections import OrderedDict
 import numpy as np
 from .iqbase import IQBase
 import pytdms
-from nptdms import TdmsFile
+
+# flags in the table of contents of a segment lead in
+TDMS_TOC_META_DATA = 1 << 1
+TDMS_TOC_NEW_OBJ_LIST = 1 << 2
+TDMS_TOC_RAW_DATA = 1 << 3
+TDMS_TOC_INTERLEAVED_DATA = 1 << 5
+TDMS_TOC_BIG_ENDIAN = 1 << 6
+TDMS_TOC_DAQMX_RAW_DATA = 1 << 7
+
+# tag, table of contents, version, next segment offset and raw data offset
+TDMS_LEAD_IN_SIZE = 28
+TDMS_NO_RAW_DATA = 0xFFFFFFFF
+TDMS_SAME_RAW_DATA_INDEX = 0
+TDMS_STRING = 0x20
+TDMS_TIMESTAMP = 0x44
+
+# numpy types of the TDMS data type codes, extended floats are kept as raw bytes
+TDMS_DATA_TYPES = {0x01: 'i1', 0x02: 'i2', 0x03: 'i4', 0x04: 'i8',
+                   0x05: 'u1', 0x06: 'u2', 0x07: 'u4', 0x08: 'u8',
+                   0x09: 'f4', 0x0A: 'f8', 0x0B: 'V16',
+                   0x19: 'f4', 0x1A: 'f8', 0x1B: 'V16',
+                   0x21: 'u1', 0x44: 'V16',
+                   0x08000C: 'c8', 0x10000D: 'c16'}
+
+TDMS_I_CHANNEL = "/'RecordData'/'I'"
+TDMS_Q_CHANNEL = "/'RecordData'/'Q'"
+TDMS_GAIN_CHANNEL = "/'RecordHeader'/'gain'"
 
 
 class TDMSData(IQBase):
+    header_fields = ('fs', 'rf_att', 'center', 'date_time', 'nsamples_total', 'scale',
+                     'tdms_first_rec_size', 'tdms_other_rec_size',
+                     'tdms_nSamplesPerRecord', 'tdms_nRecordsPerFile',
+                     'tdms_data_type', 'tdms_index')
+
     def __init__(self, filename):
         super().__init__(filename)
 
@@ -26,19 +59,31 @@ class TDMSData(IQBase):
         self.tdms_nRecordsPerFile = 0
         self.information_read = False
 
+        # one row per chunk of raw data: byte offset of I, byte offset of Q and number of samples
+        self.tdms_index = np.zeros((0, 3), dtype=np.int64)
+        self.tdms_data_type = '<i2'
+        self.tdms_index_starts = np.zeros(1, dtype=np.int64)
+
         self.rf_att = 0.0
         self.date_time = ''
-        
-        self.read_tdms_information()
+
+        if self.load_indexed_header():
+            self.tdms_index = np.array(self.tdms_index, dtype=np.int64).reshape(-1, 3)
+            self.set_index_starts()
+            self.information_read = True
+        else:
+            self.read_tdms_information()
+            if self.information_read:
+                self.store_indexed_header()
 
     def read(self, nframes=10, lframes=1024, sframes=0):
         self.read_samples(nframes * lframes, offset=sframes * lframes)
 
     def read_samples(self, nsamples, offset=0):
         """
-        Read from TDMS Files: Check the amount needed corresponds to how many records. Then read those records only
-        and from them return only the desired amount. This way the memory footprint is smallest passible and it is
-        also fast.
+        Read from TDMS Files: The segment index tells where the I and Q values of each record
+        are, so only the records covering the requested range are touched, directly from a
+        memory map of the file. No other records need to be parsed.
         """
 
         if not self.information_read:
@@ -48,87 +93,60 @@ class TDMSData(IQBase):
             raise ValueError(
                 'Requested number of samples is larger than the available {} samples.'.format(self.nsamples_total))
 
-        # let's see this amount corresponds to which start record
-        # start at the beginning of
-        start_record = int(offset / self.tdms_nSamplesPerRecord) + 1
-        starting_sample_within_start_record = offset % self.tdms_nSamplesPerRecord
-
-        # See how many records should we read, considering also the half-way started record?
-        n_records = int((starting_sample_within_start_record +
-                         nsamples) / self.tdms_nSamplesPerRecord) + 1
-
-        # that would be too much
-        if start_record + n_records - 1> self.tdms_nRecordsPerFile:
-            raise ValueError(
-                f'Requested number of records is larger than the available {self.tdms_nRecordsPerFile} records.')
-
-        # instead of real file size find out where to stop
-        absolute_size = self.tdms_first_rec_size + \
-            (start_record + n_records - 2) * self.tdms_other_rec_size
-
-        # We start with empty data
-        objects = {}
-        raw_data = {}
-
-        f = open(self.filename, "rb")  # Open in binary mode for portability
-
-        # While there's still something left to read
-        while f.tell() < absolute_size:
-            # loop until first record is filled up
-            # we always need to read the first record.
-            # don't jump if start record is 1, just go on reading
-            if start_record > 1 and f.tell() == self.tdms_first_rec_size:
-                # reached the end of first record, now do the jump
-                f.seek(f.tell() + (start_record - 2)
-                       * self.tdms_other_rec_size)
-            if f.tell() == self.tdms_first_rec_size:
-                log.info('Reached end of first record.')
-            # Now we read record by record
-            try:
-                objects, raw_data = pytdms.readSegment(
-                    f, absolute_size, (objects, raw_data))
-            except:
-                log.error('File seems to end here!')
-                return
-        # ok, now close the file
-        f.close()
-
-        # up to now, we have read only the amount of needed records times number of samples per record
-        # this is of course more than what we actually need.
+        self.data_array = self.read_into(
+            self.get_memmap(), nsamples, offset, np.empty(nsamples, dtype=self.dtype))
+        log.info("TDMS Read finished.")
 
-        # convert array.array to np.array
-        ii = np.frombuffer(raw_data[b"/'RecordData'/'I'"], dtype=np.int16)
-        qq = np.frombuffer(raw_data[b"/'RecordData'/'Q'"], dtype=np.int16)
+    def read_into(self, source, nsamples, offset, out):
+        """Read samples from the mapped file into a preallocated array.
 
-        # get rid of duplicates at the beginning if start record is larger than one
-        if start_record > 1:
-            ii = ii[self.tdms_nSamplesPerRecord:]
-            qq = qq[self.tdms_nSamplesPerRecord:]
+        Args:
+            source (numpy.memmap): The file mapped as bytes, as returned by get_memmap
+            nsamples (int): Number of samples to read
+            offset (int): Starting sample
+            out (ndarray): Complex valued array of length nsamples to be filled
 
-        ii = ii[starting_sample_within_start_record:starting_sample_within_start_record + nsamples]
-        qq = qq[starting_sample_within_start_record:starting_sample_within_start_record + nsamples]
+        Returns:
+            (ndarray): out
+        """
+        itemsize = np.dtype(self.tdms_data_type).itemsize
+        # the chunk containing the first sample
+        row = np.searchsorted(self.tdms_index_starts, offset, side='right') - 1
+        pos = 0
+        while pos < nsamples:
+            i_offset, q_offset, n = self.tdms_index[row]
+            start = offset + pos - self.tdms_index_starts[row]
+            count = min(n - start, nsamples - pos)
+            ii = source[i_offset + start * itemsize:i_offset + (start + count) * itemsize]
+            qq = source[q_offset + start * itemsize:q_offset + (start + count) * itemsize]
+            # scale straight into the real and imaginary parts, no temporary arrays needed
+            np.multiply(ii.view(self.tdms_data_type), self.scale, out=out.real[pos:pos + count])
+            np.multiply(qq.view(self.tdms_data_type), self.scale, out=out.imag[pos:pos + count])
+            pos += count
+            row += 1
+        return out
+
+    def get_memmap(self):
+        """Map the whole file into memory as bytes. Nothing is read from disk until the
+        returned array is sliced.
+
+        Returns:
+            (numpy.memmap): Read-only array of bytes
+        """
+        return np.memmap(self.filename, dtype=np.uint8, mode='r')
 
-        # Vectorized is slow, so do interleaved copy instead
-        self.data_array = np.zeros(2 * nsamples, dtype=np.float32)
-        self.data_array[::2], self.data_array[1::2] = ii, qq
-        self.data_array = self.data_array.view(np.complex64)
-        gain = np.frombuffer(
-            raw_data[b"/'RecordHeader'/'gain'"], dtype=np.float64)
-        self.scale = gain[0]
-        self.data_array = self.data_array * self.scale
-        log.info("TDMS Read finished.")
+    def _open_chunk_source(self):
+        if not self.information_read:
+            self.read_tdms_information()
+        return self.get_memmap()
 
+    def _read_chunk(self, source, offset, out):
+        self.read_into(source, len(out), offset, out)
 
     def read_complete_file(self):
-        tdms_file = TdmsFile.read(self.filename) 
-        i_channel = tdms_file['RecordData']['I']
-        q_channel = tdms_file['RecordData']['Q']
-        #timestamp_channel = tdms_file['RecordHeader']['absolute timestamp']
-        gain_channel = tdms_file['RecordHeader']['gain']
-        self.scale = gain_channel[0]
-        data = np.zeros(2 * i_channel[:].size, dtype=np.float32)
-        data[::2], data[1::2] = i_channel[:], q_channel[:]
-        self.data_array = data.view(np.complex64) * self.scale
+        """Read a complete TDMS file. Hope you know what you are doing!
+        """
+        self.read_samples(self.nsamples_total)
 
     def read_complete_file_old(self):
         """
@@ -148,67 +166,234 @@ class TDMSData(IQBase):
         # Vectorized is slow, so do interleaved copy instead
 
         len = np.shape(ii)[0]
-        self.data_array = np.zeros(2 * len, dtype=np.float32)
+        self.data_array = np.zeros(2 * len, dtype=self.get_real_dtype())
         self.data_array[::2], self.data_array[1::2] = ii, qq
-        self.data_array = self.data_array.view(np.complex64)
+        self.data_array = self.data_array.view(self.dtype)
         gain = np.frombuffer(
             raw_data[b"/'RecordHeader'/'gain'"], dtype=np.float64)
         self.scale = gain[0]
-        self.data_array = self.data_array * self.scale
+        self.data_array *= self.scale
         log.info("TDMS Read finished.")
 
     def read_tdms_information(self):
         """
-        Performs one read on the file in order to get the values
+        Walks once through the segments of the file, reading only their lead in and meta data,
+        and builds the index of the I and Q raw data. Properties and the gain are read on the way.
         """
+        index = []
+        properties = {}
+        segment_ends = []
+        gain = None
 
-        # Usually size matters, but not in this case! because we only read 2 records, but anyway should be large enough.
-        sz = os.path.getsize(self.filename)
-        how_many = 0
-        last_i_ff = 0
-        last_q_ff = 0
-        # We start with empty data
-        objects = {}
-        raw_data = {}
-
-        # Read just 2 records in order to estimate the record sizes
-        f = open(self.filename, "rb")
-        while f.tell() < sz:
+        with open(self.filename, 'rb') as f:
             try:
-                objects, raw_data = pytdms.readSegment(
-                    f, sz, (objects, raw_data))
-            except:
-                log.error('TDMS file seems to end here!')
+                for segment_end, data_start, nchunks, objects, segment_properties in read_tdms_segments(f):
+                    properties.update(segment_properties.get('/', {}))
+                    if not nchunks:
+                        continue
+
+                    # position of each channel within a chunk of raw data
+                    positions = {}
+                    chunk_size = 0
+                    for path, (data_type, nvalues, nbytes) in objects:
+                        positions[path] = (chunk_size, data_type, nvalues)
+                        chunk_size += nbytes
+
+                    if gain is None and TDMS_GAIN_CHANNEL in positions:
+                        position, data_type, _ = positions[TDMS_GAIN_CHANNEL]
+                        f.seek(data_start + position)
+                        gain = float(np.frombuffer(f.read(8), dtype=data_type)[0])
+
+                    if TDMS_I_CHANNEL in positions and TDMS_Q_CHANNEL in positions:
+                        i_position, data_type, nvalues = positions[TDMS_I_CHANNEL]
+                        q_position, _, _ = positions[TDMS_Q_CHANNEL]
+                        self.tdms_data_type = data_type
+                        chunk_starts = data_start + chunk_size * np.arange(nchunks, dtype=np.int64)
+                        index.append(np.stack([chunk_starts + i_position,
+                                               chunk_starts + q_position,
+                                               np.full(nchunks, nvalues, dtype=np.int64)], axis=1))
+                        segment_ends.append(segment_end)
+            except (ValueError, struct.error) as e:
+                log.error('TDMS file seems to end here! {}'.format(e))
                 return
 
-            if b"/'RecordData'/'I'" in raw_data and b"/'RecordData'/'Q'" in raw_data:
-                # This record has both I and Q
-                last_i = raw_data[b"/'RecordData'/'I'"][-1]
-                last_q = raw_data[b"/'RecordData'/'Q'"][-1]
-                offset = f.tell()
-
-                if last_i_ff != last_i and last_q_ff != last_q:
-                    how_many += 1
-                    last_i_ff = last_i
-                    last_q_ff = last_q
-                    if how_many == 1:
-                        self.tdms_first_rec_size = offset
-                    if how_many == 2:
-                        self.tdms_other_rec_size = offset - self.tdms_first_rec_size
-                        break
-
-        self.fs = float(objects[b'/'][3][b'IQRate'][1])
-        self.rf_att = float(objects[b'/'][3][b'RFAttentuation'][1])
-        self.center = float(objects[b'/'][3][b'IQCarrierFrequency'][1])
+        if not index:
+            log.error('TDMS file contains no I and Q data.')
+            return
+
+        self.tdms_index = np.concatenate(index)
+        self.set_index_starts()
+        if gain is not None:
+            self.scale = gain
+
+        # sizes of the records as they were estimated before
+        self.tdms_first_rec_size = segment_ends[0]
+        if len(segment_ends) > 1:
+            self.tdms_other_rec_size = segment_ends[1] - segment_ends[0]
+
+        self.fs = float(properties['IQRate'])
+        self.rf_att = float(properties['RFAttentuation'])
+        self.center = float(properties['IQCarrierFrequency'])
         self.date_time = time.ctime(os.path.getmtime(self.filename))
-        self.tdms_nSamplesPerRecord = int(
-            objects[b'/'][3][b'NSamplesPerRecord'][1])
-        self.tdms_nRecordsPerFile = int(
-            objects[b'/'][3][b'NRecordsPerFile'][1])
-        self.nsamples_total = self.tdms_nSamplesPerRecord * self.tdms_nRecordsPerFile
+        self.tdms_nSamplesPerRecord = int(properties['NSamplesPerRecord'])
+        self.tdms_nRecordsPerFile = int(properties['NRecordsPerFile'])
+        # samples actually in the file, which is less than announced if the recording stopped early
+        self.nsamples_total = int(self.tdms_index_starts[-1])
 
         self.information_read = True
 
+    def set_index_starts(self):
+        """Calculate the first sample of each chunk in the index.
+        """
+        self.tdms_index_starts = np.concatenate(
+            [[0], np.cumsum(self.tdms_index[:, 2])]).astype(np.int64)
+
+
+def read_tdms_segments(f):
+    """Walk through the segments of a TDMS file. Only the lead in and the meta data of each
+    segment are read, the raw data is skipped. Interleaved and DAQmx raw data are not supported.
+
+    Args:
+        f (file): File opened in binary mode
+
+    Raises:
+        ValueError: Raises if a segment is broken or contains unsupported raw data
+
+    Yields:
+        (tuple): End of the segment, absolute offset of its raw data, number of chunks of raw data,
+        object list as (path, (numpy type, number of values, number of bytes)) in raw data order
+        and properties found in the meta data as dictionary of dictionaries per path
+    """
+    filesize = os.fstat(f.fileno()).st_size
+    objects = OrderedDict()
+    # raw data index of each object as last seen, for segments reusing it
+    last_index = {}
+    pos = 0
+    while pos + TDMS_LEAD_IN_SIZE <= filesize:
+        f.seek(pos)
+        lead_in = f.read(TDMS_LEAD_IN_SIZE)
+        if lead_in[:4] != b'TDSm':
+            raise ValueError('No TDMS segment found at byte {}.'.format(pos))
+        toc = struct.unpack('<I', lead_in[4:8])[0]
+        e = '>' if toc & TDMS_TOC_BIG_ENDIAN else '<'
+        _, next_offset, raw_offset = struct.unpack(e + 'IQQ', lead_in[8:])
+
+        if toc & (TDMS_TOC_INTERLEAVED_DATA | TDMS_TOC_DAQMX_RAW_DATA):
+            raise ValueError('Interleaved and DAQmx TDMS raw data are not supported.')
+
+        data_start = pos + TDMS_LEAD_IN_SIZE + raw_offset
+        # the last segment of an unfinished recording has no valid length
+        if next_offset == 0xFFFFFFFFFFFFFFFF:
+            segment_end = filesize
+        else:
+            segment_end = min(pos + TDMS_LEAD_IN_SIZE + next_offset, filesize)
+
+        properties = {}
+        if toc & TDMS_TOC_NEW_OBJ_LIST:
+            objects = OrderedDict()
+        if toc & TDMS_TOC_META_DATA:
+            parse_tdms_meta_data(f.read(raw_offset), e, objects, last_index, properties)
+
+        chunk_size = sum(nbytes for _, _, nbytes in objects.values())
+        nchunks = 0
+        if toc & TDMS_TOC_RAW_DATA and chunk_size:
+            # an incomplete chunk at the end of the file is dropped
+            nchunks = (segment_end - data_start) // chunk_size
+
+        yield segment_end, data_start, nchunks, list(objects.items()), properties
+        pos = segment_end
+
+
+def parse_tdms_meta_data(meta, e, objects, last_index, properties):
+    """Parse the meta data of a TDMS segment and update the object list in place.
+
+    Args:
+        meta (bytes): Meta data of the segment
+        e (str): Byte order, '<' or '>'
+        objects (OrderedDict): Object list of the segment, path -> (numpy type, number of values, number of bytes)
+        last_index (dict): Raw data index of each object as last seen, updated in place
+        properties (dict): Properties per path, updated in place
+    """
+    nobjects, = struct.unpack_from(e + 'I', meta, 0)
+    pos = 4
+    for _ in range(nobjects):
+        path, pos = read_tdms_value(meta, pos, e, TDMS_STRING)
+        index_length, = struct.unpack_from(e + 'I', meta, pos)
+        pos += 4
+        if index_length == TDMS_NO_RAW_DATA:
+            if path in objects:
+                data_type, _, _ = objects[path]
+                objects[path] = (data_type, 0, 0)
+        elif index_length == TDMS_SAME_RAW_DATA_INDEX:
+            if path not in last_index:
+                raise ValueError('No previous raw data index for {}.'.format(path))
+            objects[path] = last_index[path]
+        else:
+            data_type, _, nvalues = struct.unpack_from(e + 'IIQ', meta, pos)
+            if data_type == TDMS_STRING:
+                nbytes, = struct.unpack_from(e + 'Q', meta, pos + 16)
+                dtype = 'V1'
+            else:
+                dtype = get_tdms_dtype(data_type, e).str
+                nbytes = nvalues * np.dtype(dtype).itemsize
+            objects[path] = (dtype, nvalues, nbytes)
+            last_index[path] = objects[path]
+            pos += index_length - 4
+
+        nproperties, = struct.unpack_from(e + 'I', meta, pos)
+        pos += 4
+        for _ in range(nproperties):
+            name, pos = read_tdms_value(meta, pos, e, TDMS_STRING)
+            data_type, = struct.unpack_from(e + 'I', meta, pos)
+            value, pos = read_tdms_value(meta, pos + 4, e, data_type)
+            properties.setdefault(path, {})[name] = value
+
+
+def get_tdms_dtype(data_type, e):
+    """Return the numpy type of a TDMS data type code.
+
+    Args:
+        data_type (int): TDMS data type code
+        e (str): Byte order, '<' or '>'
+
+    Returns:
+        (numpy.dtype): Type with the given byte order
+
+    Raises:
+        ValueError: Raises if the data type is not supported
+    """
+    if data_type not in TDMS_DATA_TYPES:
+        raise ValueError('Unsupported TDMS data type 0x{:X}.'.format(data_type))
+    return np.dtype(TDMS_DATA_TYPES[data_type]).newbyteorder(e)
+
+
+def read_tdms_value(buffer, pos, e, data_type):
+    """Read a single value of a TDMS data type, e.g. of a property.
+
+    Args:
+        buffer (bytes): Buffer containing the value
+        pos (int): Position of the value
+        e (str): Byte order, '<' or '>'
+        data_type (int): TDMS data type code
+
+    Returns:
+        (tuple): The value and the position after it. Time stamps are returned as seconds since 1904.
+    """
+    if data_type == TDMS_STRING:
+        length, = struct.unpack_from(e + 'I', buffer, pos)
+        return buffer[pos + 4:pos + 4 + length].decode('utf-8', errors='replace'), pos + 4 + length
+    if data_type == TDMS_TIMESTAMP:
+        if e == '<':
+            fractions, seconds = struct.unpack_from('<Qq', buffer, pos)
+        else:
+            seconds, fractions = struct.unpack_from('>qQ', buffer, pos)
+        return seconds + fractions / 2 ** 64, pos + 16
+    dtype = get_tdms_dtype(data_type, e)
+    value = np.frombuffer(buffer, dtype=dtype, count=1, offset=pos)[0]
+    if dtype.kind != 'V':
+        value = value.item()
+    return value, pos + dtype.itemsize
+
 
 # ---------
 # Test functions
@@ -225,4 +410,3 @@ def test_reader_functions(filename, first, last):
         a = iq1.data_array[i * lframes: (i+1) * lframes]
         b = iq2.data_array
         assert(np.array_equal(a,b))
-        
\ No newline at end of file
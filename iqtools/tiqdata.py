@@ -11,11 +11,30 @@ import numpy as np
 import xml.etree.ElementTree as et
 from .iqbase import IQBase
 
+# the first line and usually the whole XML header fit into the first read
+TIQ_HEADER_READ_SIZE = 2 ** 16
+
+# attribute, part of the tag, excluded part of the tag and type of the header fields,
+# each field is taken from the first element with a matching tag
+TIQ_HEADER_TAGS = (('date_time', 'DateTime', None, str),
+                   ('center', 'Frequency', 'Sampling', float),
+                   ('acq_bw', 'AcquisitionBandwidth', None, float),
+                   ('nsamples_total', 'NumberSamples', None, int),
+                   ('rf_att', 'RFAttenuation', None, float),
+                   ('fs', 'SamplingFrequency', None, float),
+                   ('scale', 'Scaling', None, float))
+
 
 class TIQData(IQBase):
-    def __init__(self, filename):
+    header_fields = ('date_time', 'center', 'acq_bw', 'nsamples_total', 'rf_att',
+                     'fs', 'scale', 'span', 'rbw', 'data_offset')
+
+    def __init__(self, filename, use_mmap=True):
         super().__init__(filename)
 
+        # access the samples through a memory map instead of reading them
+        self.use_mmap = use_mmap
+
         # Additional fields in this subclass
         self.date_time = ''
         self.span = 0.0
@@ -26,7 +45,9 @@ class TIQData(IQBase):
         self.data_offset = 0
 
         self.header = ''
-        self.read_header()
+        if not self.load_indexed_header():
+            self.read_header()
+            self.store_indexed_header()
 
     def read(self, nframes=10, lframes=1024, sframes=0):
         """Read a section of the file.
@@ -53,30 +74,54 @@ class TIQData(IQBase):
             raise ValueError(
                 'Requested number of samples is larger than the available {} samples.'.format(self.nsamples_total))
 
-        total_n_bytes = 8 * nsamples  # 8 comes from 2 times 4 byte integer for I and Q
-        start_n_bytes = 8 * offset
-
-        # file might have the correcct size, but the data not copied fully
-        try:
-            with open(self.filename, 'rb') as f:
-                f.seek(self.data_offset + start_n_bytes)
-                ba = f.read(total_n_bytes)
-        except:
-            log.error('File seems to end here!')
-            return
-
-        # return a numpy array of little endian 8 byte floats (known as doubles)
-        # little endian 4 byte ints.
-        self.data_array = np.fromstring(ba, dtype='<i4')
-        # Scale to retrieve value in Volts. Augmented assignment does not work here!
-        self.data_array = self.data_array * self.scale
-        self.data_array = self.data_array.view(
-            dtype='c16')  # reinterpret the bytes as a 16 byte complex number, which consists of 2 doubles.
+        if self.use_mmap:
+            # only the pages covering the requested range are touched
+            raw = self.get_memmap()[offset:offset + nsamples]
+            if len(raw) < nsamples:
+                log.error('File seems to end here!')
+                return
+        else:
+            total_n_bytes = 8 * nsamples  # 8 comes from 2 times 4 byte integer for I and Q
+            start_n_bytes = 8 * offset
+
+            # file might have the correcct size, but the data not copied fully
+            try:
+                with open(self.filename, 'rb') as f:
+                    f.seek(self.data_offset + start_n_bytes)
+                    ba = f.read(total_n_bytes)
+            except:
+                log.error('File seems to end here!')
+                return
+            # little endian 4 byte ints.
+            raw = np.frombuffer(ba, dtype='<i4').reshape(-1, 2)
+
+        # Scale to retrieve value in Volts. The I and Q columns are written straight
+        # into the real and imaginary parts, this is the only copy of the data.
+        self.data_array = self.scale_iq(raw, self.scale, np.empty(len(raw), dtype=self.dtype))
 
         log.info("Output complex array has a size of {}.".format(
             self.data_array.size))
         # in order to read you may use: data = x.item()['data'] or data = x[()]['data'] other wise you get 0-d error
 
+    def get_memmap(self):
+        """Map the I/Q payload after the XML header into memory. Nothing is read from
+        disk until the returned array is sliced. The values are raw, i.e. not scaled.
+
+        Returns:
+            (numpy.memmap): Read-only array of little endian 4 byte ints with shape (nsamples, 2)
+        """
+        # file might have the correct size, but the data not copied fully
+        nsamples = min(self.nsamples_total,
+                       (os.path.getsize(self.filename) - self.data_offset) // 8)
+        return np.memmap(self.filename, dtype='<i4', mode='r',
+                         offset=self.data_offset, shape=(nsamples, 2))
+
+    def _open_chunk_source(self):
+        return self.get_memmap()
+
+    def _read_chunk(self, source, offset, out):
+        self.scale_iq(source[offset:offset + len(out)], self.scale, out)
+
     def read_header(self):
         """Parse TIQ header
         The following information are extracted. Data needs to be normalized over 50 ohm.
@@ -95,48 +140,43 @@ class TIQData(IQBase):
         Voltage Scaling
         """
 
-        ba = bytearray('', encoding='UTF-8')
-        b = b''
-        with open(self.filename, 'rb') as f:
-            while b != b'\n':
-                b = f.read(1)
-                ba.extend(b)
-
-        self.data_offset = int(ba.decode().split("\"")[1])
-
         with open(self.filename, 'rb') as f:
-            ba = f.read(self.data_offset)
-        self.header = ba
-        xml_tree_root = et.fromstring(ba)
-
-        self.date_time = [e.text for e in xml_tree_root.iter(
-            '*') if 'DateTime' in e.tag][0]
-        self.center = float([e.text for e in xml_tree_root.iter(
-            '*') if 'Frequency' in e.tag and 'Sampling' not in e.tag][0])
-        self.acq_bw = float([e.text for e in xml_tree_root.iter(
-            '*') if 'AcquisitionBandwidth' in e.tag][0])
-        self.nsamples_total = int(
-            [e.text for e in xml_tree_root.iter('*') if 'NumberSamples' in e.tag][0])
-        self.rf_att = float([e.text for e in xml_tree_root.iter(
-            '*') if 'RFAttenuation' in e.tag][0])
-        self.fs = float([e.text for e in xml_tree_root.iter(
-            '*') if 'SamplingFrequency' in e.tag][0])
-        self.scale = float(
-            [e.text for e in xml_tree_root.iter('*') if 'Scaling' in e.tag][0])
-
-        for elem in xml_tree_root.iter('NumericParameter'):
-            if 'name' in elem.attrib and elem.attrib['name'] == 'Span' and (elem.attrib['pid'] == 'specanrange' or elem.attrib['pid'] == 'globalrange'):
-                self.span = float(elem.find('Value').text)
-
+            ba = f.read(TIQ_HEADER_READ_SIZE)
+            # the offset of the data is the first quoted value in the first line
+            self.data_offset = int(ba[:ba.index(b'\n')].split(b'"')[1])
+            if self.data_offset > len(ba):
+                ba += f.read(self.data_offset - len(ba))
+        self.header = ba[:self.data_offset]
+        xml_tree_root = et.fromstring(self.header)
+
+        values = {}
+        self.span = 0.0
         self.rbw = 0.0
-        for elem in xml_tree_root.iter('NumericParameter'):
-            if 'name' in elem.attrib and elem.attrib['name'] == 'Resolution Bandwidth' and elem.attrib['pid'] == 'fmtRBW':
-                self.rbw = float(elem.find('Value').text)
+        for elem in xml_tree_root.iter('*'):
+            for name, part, excluded, _ in TIQ_HEADER_TAGS:
+                if name not in values and part in elem.tag and (excluded is None or excluded not in elem.tag):
+                    values[name] = elem.text
+            # the last matching span and resolution bandwidth are taken
+            if elem.tag == 'NumericParameter' and 'name' in elem.attrib:
+                if elem.attrib['name'] == 'Span' and elem.attrib.get('pid') in ('specanrange', 'globalrange'):
+                    self.span = float(elem.find('Value').text)
+                elif elem.attrib['name'] == 'Resolution Bandwidth' and elem.attrib.get('pid') == 'fmtRBW':
+                    self.rbw = float(elem.find('Value').text)
+
+        for name, part, _, to_type in TIQ_HEADER_TAGS:
+            if name not in values:
+                raise ValueError('No {} found in the header.'.format(part))
+            setattr(self, name, to_type(values[name]))
 
     def save_header(self):
         """Saves the header byte array into a txt tile.
         """        
 
+        # header fields might have been taken from the header index
+        if not self.header:
+            with open(self.filename, 'rb') as f:
+                self.header = f.read(self.data_offset)
+
         with open(self.filename_wo_ext + '.xml', 'wb') as f3:
             f3.write(self.header)
         log.info("Header saved in an xml file.")
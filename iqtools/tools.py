@@ -5,6 +5,7 @@ xaratustrah@github 2017
 """
 
 import os
+import glob
 import logging as log
 from scipy.signal import hilbert
 from scipy.io import wavfile
@@ -13,6 +14,7 @@ import numpy as np
 import nibabel as nib
 from bs4 import BeautifulSoup
 from scipy.optimize import curve_fit
+from concurrent.futures import ProcessPoolExecutor
 
 
 import types
@@ -33,6 +35,13 @@ from .r3fdata import R3FData
 
 # ------------ TOOLS ----------------------------
 
+# file extensions known to get_iq_object
+IQ_FILE_EXTENSIONS = ['.txt', '.csv', '.bin', '.wav', '.iqt',
+                      '.iq', '.tiq', '.tdms', '.r3f', '.dat', '.xdat']
+
+# rows of a spectrogram processed at once while cooling
+COOLING_BLOCK_ROWS = 1024
+
 # ----------------------------
 # general functions
 
@@ -102,6 +111,30 @@ def get_iq_object(filename, header_filename=None):
     return iq_data
 
 
+def find_iq_files(paths):
+    """Expand file names, glob patterns and directories into a list of data files.
+    Directories are searched (not recursively) for files with extensions known to get_iq_object.
+
+    Args:
+        paths (list): File names, glob patterns or directories
+
+    Returns:
+        (list): File names in the given order, sorted within each pattern or directory
+    """
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if os.path.splitext(name)[1].lower() in IQ_FILE_EXTENSIONS and os.path.isfile(os.path.join(path, name)):
+                    filenames.append(os.path.join(path, name))
+        elif any(c in path for c in '*?['):
+            filenames += sorted(glob.glob(path))
+        else:
+            filenames.append(path)
+    # remove duplicates but keep the order
+    return list(dict.fromkeys(filenames))
+
+
 def get_eng_notation(value, unit='', decimal_place=2):
     """Convert numbers to scientific notation
 
@@ -352,9 +385,77 @@ def get_averaged_spectrogram(xx, yy, zz, every):
 
     return xx[:dim3], yy, zz
 
-def get_cooled_spectrogram(xx, yy, zz, yy_idx, fill_with=0):
+def get_cooling_shifts(zz, yy_idx, method='argmax', subbin=False):
+    """Find the shift of every row of the spectrogram relative to a reference row.
+
+    Args:
+        zz (ndarray): Power meshgrid
+        yy_idx (int): Index of the reference row
+        method (str, optional): 'argmax' compares the positions of the row maxima, 'xcorr' takes the lag of
+            the maximum of the cross correlation with the reference row, which also works for broad or
+            multiple peaks. Defaults to 'argmax'.
+        subbin (bool, optional): Interpolate the maxima with a parabola for shifts with fractions of bins. Defaults to False.
+
+    Returns:
+        (tuple): Position of the maximum of the reference row, array of shifts in bins
+    """
+    nrows, nbins = np.shape(zz)
+    b = int(np.argmax(zz[yy_idx]))
+    rows = np.arange(nrows)
+
+    if method == 'argmax':
+        peaks = np.argmax(zz, axis=1)
+        shifts = peaks - b
+        if subbin:
+            shifts = shifts + _get_parabola_vertex(zz, rows, peaks)
+
+    elif method == 'xcorr':
+        # zero padding to twice the length avoids wrapping of the correlation
+        n = 2 * nbins
+        ref = zz[yy_idx] - np.median(zz[yy_idx])
+        ref_conj = np.conj(np.fft.rfft(ref, n=n))
+        peaks = np.empty(nrows, dtype=np.int64)
+        vertices = np.zeros(nrows)
+        for start in range(0, nrows, COOLING_BLOCK_ROWS):
+            block = zz[start:start + COOLING_BLOCK_ROWS]
+            block = block - np.median(block, axis=1, keepdims=True)
+            corr = np.fft.irfft(np.fft.rfft(block, n=n, axis=1) * ref_conj, n=n, axis=1)
+            lags = np.argmax(corr, axis=1)
+            peaks[start:start + len(block)] = lags
+            if subbin:
+                vertices[start:start + len(block)] = _get_parabola_vertex(
+                    corr, np.arange(len(block)), lags, circular=True)
+        # lags beyond half the length are negative
+        shifts = np.where(peaks >= nbins, peaks - n, peaks)
+        if subbin:
+            # the reference row keeps the position of its maximum
+            shifts = shifts + vertices - vertices[yy_idx]
+
+    else:
+        raise ValueError('Unknown method {}.'.format(method))
+
+    return b, shifts
+
+
+def _get_parabola_vertex(zz, rows, peaks, circular=False):
+    # offset of the vertex of the parabola through each peak and its neighbours
+    nbins = np.shape(zz)[1]
+    if circular:
+        left, right = (peaks - 1) % nbins, (peaks + 1) % nbins
+    else:
+        left, right = np.maximum(peaks - 1, 0), np.minimum(peaks + 1, nbins - 1)
+    ym, y0, yp = zz[rows, left], zz[rows, peaks], zz[rows, right]
+    curvature = ym - 2 * y0 + yp
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vertex = np.where(curvature < 0, (ym - yp) / (2 * curvature), 0)
+    return np.clip(vertex, -0.5, 0.5)
+
+
+def get_cooled_spectrogram(xx, yy, zz, yy_idx, fill_with=0, method='argmax', subbin=False, out=None, sparse=False):
     """Software cool the spectrogram. Shifts rows to match the maximum of the selected time frame.
     After cooling / shifting, the frequency axis will have useless information. so it is left as just numbers.
+    The rows are padded on the right by the position of the maximum of the selected time frame, the
+    shifts wrap around within each padded row.
 
     Args:
         xx (ndarray): Frequency meshgrid
@@ -362,57 +463,200 @@ def get_cooled_spectrogram(xx, yy, zz, yy_idx, fill_with=0):
         zz (ndarray): Power meshgrid
         yy_idx (int): Selected time frame for searching the maximum
         fill_with (int, optional): Fill with this instead of zeros. Defaults to 0.
+        method (str, optional): How the shifts are found, 'argmax' or 'xcorr', see get_cooling_shifts. Defaults to 'argmax'.
+        subbin (bool, optional): Shift by fractions of bins, using phase ramps in the Fourier domain. Defaults to False.
+        out (ndarray, optional): Array of shape (nrows, nbins + maximum position) to write the result into. Defaults to None.
+        sparse (bool, optional): Return sparse meshgrids. Defaults to False.
 
     Returns:
         (tuple): Tuple of meshgrids
     """    
 
-    # make sure fill_with does not exceed the maximum in the row
-    
-    b = np.argmax(zz[yy_idx])
-    z = np.ones((np.shape(zz)[0],b)) * fill_with
-    w = np.concatenate((zz.T, z.T)).T
-    newarr = np.zeros(np.shape(w))
-    ii = 0
-    # calculate distance and subtract in each row
-    for row in w:
-        diff =np.argmax(row) - b 
-        newarr[ii] = np.roll(row, - diff)
-        ii+=1
-    
-    xc, yc = np.meshgrid(np.arange(np.shape(newarr)[1]), np.arange(np.shape(newarr)[0]))
+    nrows, nbins = np.shape(zz)
+    b, shifts = get_cooling_shifts(zz, yy_idx, method=method, subbin=subbin)
+    width = nbins + b
+    if out is None:
+        out = np.empty((nrows, width), dtype=np.result_type(zz.dtype, np.float32))
+    elif np.shape(out) != (nrows, width):
+        raise ValueError('Output array must have the shape {}.'.format((nrows, width)))
+
+    # the rows are shifted in blocks, so no padded copy of the whole array is needed
+    for start in range(0, nrows, COOLING_BLOCK_ROWS):
+        stop = min(start + COOLING_BLOCK_ROWS, nrows)
+        block = zz[start:stop]
+        block_shifts = shifts[start:stop]
+        if subbin:
+            padded = np.full((stop - start, width), fill_with, dtype=np.float64)
+            padded[:, :nbins] = block
+            ramp = np.exp(2j * np.pi * np.outer(block_shifts, np.fft.rfftfreq(width)))
+            out[start:stop] = np.fft.irfft(np.fft.rfft(padded, axis=1) * ramp, n=width, axis=1)
+        else:
+            # gather from the padded row, indices beyond the row are the padding
+            idx = np.add.outer(block_shifts.astype(np.intp), np.arange(width, dtype=np.intp))
+            idx[idx < 0] += width
+            idx[idx >= width] -= width
+            padding = idx >= nbins
+            idx += (np.arange(stop - start, dtype=np.intp) * nbins)[:, np.newaxis]
+            np.take(np.ascontiguousarray(block), idx, out=out[start:stop], mode='clip')
+            out[start:stop][padding] = fill_with
+
+    xc, yc = np.meshgrid(np.arange(width), np.arange(nrows), sparse=sparse)
     # use the same time axis
     delta_y = yy[1][0] - yy[0][0]
 
-    # 
-    
-    return xc, yc * delta_y, newarr    
+    return xc, yc * delta_y, out
 
 
-def get_gaussian_sigma_vs_time(xx, yy, zz):
-    """Fits a Gaussian along every slice of power zz for each row in yy (i.e. time frame)
+def _gaussian_func(x, amplitude, mean, sigma):
+    return amplitude * np.exp(-(x - mean)**2 / (2 * sigma**2))
+
+
+def get_gaussian_estimates(zz, method='parabola', snr=13):
+    """Closed form estimates of Gaussian peaks for all rows of zz at once, in units of bins.
+    Both methods use the bins around the peak of each row, where the row stays above half
+    of its maximum. Rows whose maximum is not at least snr above the median of the row, i.e.
+    its noise floor, contain no peak and are NaN.
+
+    Args:
+        zz (ndarray): Power meshgrid
+        method (str, optional): 'parabola' fits a parabola to the logarithm of the bins above half
+            maximum, weighted by their power. 'moments' takes the mean and the standard deviation of
+            the row above its median, within three times the width at half maximum. Defaults to 'parabola'.
+        snr (float, optional): Minimum height of the maximum above the noise floor in [dB]. Defaults to 13.
+
+    Returns:
+        (tuple): Arrays of amplitudes, means and sigmas, NaN for rows without a usable peak
+    """
+    zz = np.atleast_2d(np.asarray(zz, dtype=np.float64))
+    nrows, nbins = zz.shape
+    rows = np.arange(nrows)
+    bins = np.arange(nbins)
+
+    # at least the neighbours of the peak, peaks at the edges get their neighbours from inside the row
+    k = np.clip(zz.argmax(axis=1), 1, nbins - 2)
+    peaks = zz[rows, k]
+    below = zz < peaks[:, np.newaxis] / 2
+    left = below & (bins < k[:, np.newaxis] - 1)
+    right = below & (bins > k[:, np.newaxis] + 1)
+    lo = np.where(left.any(axis=1), nbins - left[:, ::-1].argmax(axis=1), 0)
+    hi = np.where(right.any(axis=1), right.argmax(axis=1) - 1, nbins - 1)
+    # rows of noise only
+    noise_floor = np.median(zz, axis=1)
+    failed = ~(peaks > 0) | ~(zz.max(axis=1) >= noise_floor * 10 ** (snr / 10))
+
+    if method == 'parabola':
+        x = bins - k[:, np.newaxis]
+        window = (bins >= lo[:, np.newaxis]) & (bins <= hi[:, np.newaxis])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            y = np.where(window, np.log(np.where(zz > 0, zz, 1)), 0)
+            # the error of log(z) goes with 1 / z
+            w = np.where(failed[:, np.newaxis], window, window * (zz / peaks[:, np.newaxis]) ** 2)
+        sx = np.stack([np.sum(w * x ** i, axis=1) for i in range(5)], axis=1)
+        sxy = np.stack([np.sum(w * x ** i * y, axis=1) for i in range(3)], axis=1)
+        # weighted least squares of c0 + c1 x + c2 x^2
+        a = sx[:, [[0, 1, 2], [1, 2, 3], [2, 3, 4]]]
+        failed |= ~(np.abs(np.linalg.det(a)) > 0)
+        a[failed] = np.eye(3)
+        c0, c1, c2 = np.linalg.solve(a, sxy[..., np.newaxis])[..., 0].T
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sigmas = np.sqrt(-1 / (2 * c2))
+            means = k - c1 / (2 * c2)
+            amplitudes = np.exp(c0 - c1 ** 2 / (4 * c2))
+        failed |= ~(c2 < 0) | ~((means >= 0) & (means <= nbins - 1))
+
+    elif method == 'moments':
+        half = 1.5 * (hi - lo + 1)
+        window = np.abs(bins - k[:, np.newaxis]) <= half[:, np.newaxis]
+        weights = np.clip(zz - np.median(zz, axis=1, keepdims=True), 0, None) * window
+        total = weights.sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means = weights @ bins / total
+            sigmas = np.sqrt(np.einsum('ij,ij->i', weights, (bins - means[:, np.newaxis]) ** 2) / total)
+        amplitudes = weights.max(axis=1)
+        failed |= ~(total > 0)
+
+    else:
+        raise ValueError('Unknown method {}.'.format(method))
+
+    failed |= ~np.isfinite(sigmas) | ~(sigmas > 0)
+    for arr in (amplitudes, means, sigmas):
+        arr[failed] = np.nan
+    return amplitudes, means, sigmas
+
+
+def _fit_gaussian_rows(zz, p0):
+    # one curve fit per row, seeded with the estimates, failed rows give NaN
+    x_data = np.arange(zz.shape[1])
+    popt = np.full((len(zz), 3), np.nan)
+    for i, (row, guess) in enumerate(zip(zz, p0)):
+        if not np.all(np.isfinite(guess)):
+            continue
+        try:
+            popt[i], _ = curve_fit(_gaussian_func, x_data, row, p0=guess)
+        except (RuntimeError, ValueError) as e:
+            log.debug('Gaussian fit of row {} failed: {}'.format(i, e))
+    return popt
+
+
+def get_gaussian_fits(xx, zz, method='parabola', refine=False, jobs=1, snr=13):
+    """Fits a Gaussian to every row of power zz. The closed form estimates of get_gaussian_estimates
+    are used directly or as the starting point of a nonlinear fit. Rows where the estimate or the fit
+    fail are NaN instead of raising an error.
 
     Args:
         xx (ndarray): Frequency meshgrid
-        yy (ndarray): Time meshgrid
         zz (ndarray): Power meshgrid
-        
+        method (str, optional): Method of the estimates, see get_gaussian_estimates. Defaults to 'parabola'.
+        refine (bool, optional): Refine the estimates with scipy.optimize.curve_fit. Defaults to False.
+        jobs (int, optional): Number of processes for the refinement. Defaults to 1.
+        snr (float, optional): Rows without a maximum this far above their noise floor in [dB] are NaN, see get_gaussian_estimates. Defaults to 13.
+
     Returns:
-        flat arrays times and sigmas
+        (tuple): Arrays of amplitudes, means in [Hz], sigmas in [Hz] and the coefficient of determination R^2 of each row
     """
-    def gaussian_func(x, amplitude, mean, sigma):
-        return amplitude * np.exp(-(x - mean)**2 / (2 * sigma**2))
+    zz = np.atleast_2d(np.asarray(zz, dtype=np.float64))
+    params = np.column_stack(get_gaussian_estimates(zz, method=method, snr=snr))
+
+    if refine:
+        if jobs > 1:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                parts = executor.map(_fit_gaussian_rows,
+                                     np.array_split(zz, jobs * 4), np.array_split(params, jobs * 4))
+                params = np.concatenate(list(parts))
+        else:
+            params = _fit_gaussian_rows(zz, params)
 
-    def fit_gaussian(row):
-        x_data = np.arange(len(row))
-        popt, _ = curve_fit(gaussian_func, x_data, row, p0=[1, np.argmax(row), 1])
-        return popt[2]
+    amplitudes, means, sigmas = params.T
+    sigmas = np.abs(sigmas)
+    # quality of the fit
+    residuals = zz - _gaussian_func(np.arange(zz.shape[1]), *(params[:, i, np.newaxis] for i in range(3)))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r2 = 1 - np.sum(residuals ** 2, axis=1) / np.sum((zz - zz.mean(axis=1, keepdims=True)) ** 2, axis=1)
 
-    sigmas = np.apply_along_axis(fit_gaussian, axis=1, arr=zz)
+    xx = np.atleast_2d(xx)
     delta_f = (xx[0][1] - xx[0][0])
-    
+    return amplitudes, xx[0][0] + means * delta_f, sigmas * abs(delta_f), r2
+
+
+def get_gaussian_sigma_vs_time(xx, yy, zz, method='parabola', refine=False, jobs=1, snr=13):
+    """Fits a Gaussian along every slice of power zz for each row in yy (i.e. time frame)
+
+    Args:
+        xx (ndarray): Frequency meshgrid
+        yy (ndarray): Time meshgrid
+        zz (ndarray): Power meshgrid
+        method (str, optional): Method of the estimates, see get_gaussian_estimates. Defaults to 'parabola'.
+        refine (bool, optional): Refine the estimates with scipy.optimize.curve_fit. Defaults to False.
+        jobs (int, optional): Number of processes for the refinement. Defaults to 1.
+        snr (float, optional): Rows without a maximum this far above their noise floor in [dB] are NaN, see get_gaussian_estimates. Defaults to 13.
+
+    Returns:
+        flat arrays times and sigmas, sigmas are NaN where the fit failed
+    """
+    _, _, sigmas, _ = get_gaussian_fits(xx, zz, method=method, refine=refine, jobs=jobs, snr=snr)
+
     # using yy[:,0] below we cover both cases of yy being sparse and non-sparse
-    return yy[:,0].flatten(), np.abs(sigmas * delta_f)
+    return yy[:,0].flatten(), sigmas
 
 
 # -----------------------------------------#
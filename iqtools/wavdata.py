@@ -9,7 +9,7 @@ import numpy as np
 import time
 import os
 from scipy.io import wavfile
-from logging import log
+import logging as log
 from .iqbase import IQBase
 
 
@@ -19,6 +19,9 @@ class WAVData(IQBase):
 
         # Additional fields in this subclass
         self.date_time = time.ctime(os.path.getctime(self.filename))
+        self.center = 0
+        self.nchannels = 1
+        self.read_header()
 
     def read(self, nframes=10, lframes=1024, sframes=0):
         """Read a section of the file.
@@ -32,7 +35,8 @@ class WAVData(IQBase):
         self.read_samples(nframes * lframes, offset=sframes * lframes)
 
     def read_samples(self, nsamples, offset=0):
-        """Read samples.
+        """Read samples. Only the requested window of the memory map is converted.
+        Stereo files are taken as I/Q pairs, left is I and right is Q.
 
         Args:
             nsamples (int): Number of samples to read from file
@@ -41,20 +45,54 @@ class WAVData(IQBase):
         Raises:
             ValueError: Raises if the requested number of samples is larger than available
         """        
+        if nsamples > self.nsamples_total - offset:
+            raise ValueError(
+                'Requested number of samples is larger than the available {} samples.'.format(self.nsamples_total))
 
-        # activate memory map
         try:
-            fs, data = wavfile.read(self.filename, mmap=True)
+            data = self.get_memmap()
         except:
             log.error('File seems to end here!')
             return
-        all_data = data.astype(np.complex64)
-        self.fs = fs
-        self.center = 0
-        self.nsamples_total = len(all_data)
 
-        if nsamples > self.nsamples_total - offset:
-            raise ValueError(
-                'Requested number of samples is larger than the available {} samples.'.format(self.nsamples_total))
+        self.data_array = self.get_iq(data[offset:nsamples + offset],
+                                      np.empty(nsamples, dtype=self.dtype))
+
+    def read_header(self):
+        """Read the sampling rate, the number of channels and the number of samples.
+        """
+        self.fs, data = wavfile.read(self.filename, mmap=True)
+        self.nchannels = 1 if data.ndim == 1 else data.shape[1]
+        self.nsamples_total = len(data)
+
+    def get_memmap(self):
+        """Map the samples into memory. Nothing is read from disk until the returned
+        array is sliced.
+
+        Returns:
+            (numpy.memmap): Read-only array of samples, with one column per channel for stereo files
+        """
+        _, data = wavfile.read(self.filename, mmap=True)
+        return data
+
+    def get_iq(self, raw, out):
+        """Convert a window of samples to complex values.
+
+        Args:
+            raw (ndarray): Samples as sliced from get_memmap
+            out (ndarray): Complex valued array of the same length to be filled
+
+        Returns:
+            (ndarray): out
+        """
+        if raw.ndim == 1:
+            out[:] = raw
+            return out
+        # left channel is I and right channel is Q
+        return self.scale_iq(raw[:, :2], 1, out)
+
+    def _open_chunk_source(self):
+        return self.get_memmap()
 
-        self.data_array = all_data[offset:nsamples + offset]
+    def _read_chunk(self, source, offset, out):
+        self.get_iq(source[offset:offset + len(out)], out)
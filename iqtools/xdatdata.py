@@ -58,28 +58,27 @@ class XDATData(IQBase):
             raise ValueError(
                 'Requested number of samples is larger than the available {} samples.'.format(self.nsamples_total))
 
-        total_n_bytes = 8 * nsamples  # 8 comes from 2 times 4 byte integer for I and Q
-        start_n_bytes = 8 * offset
-
-        try:
-            with open(self.filename, 'rb') as f:
-                f.seek(start_n_bytes)
-                ba = f.read(total_n_bytes)
-        except Exception as e:
-            log.error(e + 'File seems to end here!')
-            return
-
-        # return a numpy array of little endian 8 byte floats (known as doubles)
-        # little endian 4 byte ints.
-        self.data_array = np.fromstring(ba, dtype='<i4')
-        # Scale to retrieve value in Volts. Augmented assignment does not work here!
-        self.data_array = self.data_array * self.scale
-        self.data_array = self.data_array.view(
-            dtype='c16')  # reinterpret the bytes as a 16 byte complex number, which consists of 2 doubles.
+        # 16 bit little endian I and Q, scaled to Volts straight into the complex array
+        raw = self.get_memmap()[offset:offset + nsamples]
+        self.data_array = self.scale_iq(raw, self.scale, np.empty(nsamples, dtype=self.dtype))
 
         log.info("Output complex array has a size of {}.".format(
             self.data_array.size))
-        # in order to read you may use: data = x.item()['data'] or data = x[()]['data'] other wise you get 0-d error
+
+    def get_memmap(self):
+        """Map the interlaced I and Q values into memory. Nothing is read from disk until
+        the returned array is sliced. The values are raw, i.e. not scaled.
+
+        Returns:
+            (numpy.memmap): Read-only array of little endian 2 byte ints with shape (nsamples, 2)
+        """
+        return np.memmap(self.filename, dtype='<i2', mode='r', shape=(self.nsamples_total, 2))
+
+    def _open_chunk_source(self):
+        return self.get_memmap()
+
+    def _read_chunk(self, source, offset, out):
+        self.scale_iq(source[offset:offset + len(out)], self.scale, out)
 
     def read_header(self):
         """Parse XDAT header file
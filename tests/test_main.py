@@ -0,0 +1,28 @@
+import argparse
+import json
+import os
+
+from iqtools.__main__ import process_batch
+
+
+def get_args(outdir, jobs):
+    return argparse.Namespace(header_index=None, header_filename=None, nframes=10, lframes=1024,
+                              sframes=1, outdir=outdir, fft=False, psd=False, sgram=True, npy=False,
+                              dic=False, raw=False, span=None, jobs=jobs, manifest=None)
+
+
+def test_manifest_when_all_files_fail(tmp_path):
+    bad = tmp_path / 'bad.tiq'
+    bad.write_bytes(b'not a tiq file')
+    missing = tmp_path / 'nonexist.tiq'
+    outdir = tmp_path / 'out_new' / 'sub'
+
+    for jobs in (1, 2):
+        manifest = process_batch([str(bad), str(missing)], get_args(str(outdir), jobs))
+
+        assert manifest['n_files'] == 2
+        assert manifest['n_failed'] == 2
+        with open(os.path.join(str(outdir), 'iqtools_manifest.json')) as f:
+            written = json.load(f)
+        assert [entry['status'] for entry in written['files']] == ['failed', 'failed']
+        assert all(entry['error'] for entry in written['files'])